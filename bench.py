@@ -0,0 +1,221 @@
+"""Synthetic fixtures and per-stage benchmarks for the t1 report pipeline.
+
+    python bench.py --underlyings 200 1000 5000 --legs 3 --output bench_output.txt
+
+Each size gets a fresh fixture folder (positions, Collar, ALL PARAMETERS and stock codes
+exports). Every stage runs --repeat times and the best time is kept; peak memory is
+measured in one extra run under tracemalloc, so it covers Python and numpy allocations
+but not pyarrow's own buffers.
+"""
+import os
+import io
+import sys
+import csv
+import json
+import time
+import random
+import string
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+import contextlib
+
+import t1
+
+EXPIRY = '25JUN'
+CLASSIFICATIONS = ['Large', 'Mid', 'Small']
+
+
+# ==== FIXTURES ====
+def stock_names(count, rng):
+    names = set()
+    while len(names) < count:
+        names.add(''.join(rng.choice(string.ascii_uppercase) for _ in range(rng.randint(3, 10))))
+    return sorted(names)
+
+
+def position_rows(name, legs, rng):
+    """One futures leg plus legs - 1 options, alternating long puts and short calls."""
+    price = rng.uniform(50, 3000)
+    qty = rng.choice([250, 500, 1000])
+    rows = [['NRML', f'{name}{EXPIRY}FUT', qty, round(price, 2), round(price * rng.uniform(0.9, 1.1), 2),
+             round(rng.uniform(-50000, 50000), 2), round(rng.uniform(-3, 3), 2)]]
+    for i in range(1, legs):
+        leg, sign, moneyness = ('PE', 1, 0.9) if i % 2 else ('CE', -1, 1.1)
+        strike = round(price * (moneyness + 0.05 * (i // 2)))
+        rows.append(['NRML', f'{name}{EXPIRY}{strike}{leg}', sign * qty, round(price * rng.uniform(0.01, 0.06), 2),
+                     round(price * rng.uniform(0.005, 0.05), 2), round(rng.uniform(-20000, 20000), 2),
+                     rng.choice([0.000007, round(rng.uniform(-30, 30), 2)])])
+    return rows
+
+
+def near_miss(name, rng):
+    """The name with one letter replaced, as broker code lists often differ from NSE codes."""
+    i = rng.randrange(len(name))
+    return name[:i] + rng.choice(string.ascii_uppercase) + name[i + 1:]
+
+
+def generate_fixtures(directory, underlyings=1000, legs=3, watchlist=500, stock_codes=5000, date=None, seed=0):
+    """Write synthetic exports for `date` into directory; returns the number of rows written per file."""
+    rng = random.Random(seed)
+    date_str = (date or datetime.date.today()).strftime("%B %d, %Y")
+    os.makedirs(directory, exist_ok=True)
+    names = stock_names(underlyings + watchlist // 2, rng)
+    held = names[:underlyings]
+
+    positions = [row for name in held for row in position_rows(name, legs, rng)]
+    with open(os.path.join(directory, 'positions.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Product', 'Instrument', 'Qty.', 'Avg.', 'LTP', 'P&L', 'Chg.'])
+        writer.writerows(positions)
+
+    watched = rng.sample(held, min(watchlist - watchlist // 2, len(held))) + names[underlyings:]
+    with open(os.path.join(directory, f'Collar_{date_str}.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(t1.WATCHLIST_COLUMNS)
+        for name in watched:
+            writer.writerow([name, round(rng.uniform(50, 3000), 2), round(rng.uniform(-3, 3), 2),
+                             rng.randint(20, 90), rng.randint(20, 90), rng.randint(20, 90), rng.choice(CLASSIFICATIONS)])
+
+    with open(os.path.join(directory, f'ALL PARAMETERS_{date_str}.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['NSE Code'])
+        writer.writerows([name] for name in watched)
+
+    exact = rng.sample(held, min(stock_codes // 4, len(held)))
+    fuzzy = [near_miss(rng.choice(held), rng) for _ in range(min(stock_codes // 4, len(held)))]
+    other = stock_names(max(stock_codes - len(exact) - len(fuzzy), 0), rng)
+    with open(os.path.join(directory, 'stock_codes.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['m_stock_code'])
+        writer.writerows([code] for code in exact + fuzzy + other)
+
+    return {'positions': len(positions), 'watchlist': len(watched), 'stock_codes': len(exact) + len(fuzzy) + len(other)}
+
+
+# ==== STAGES ====
+def measure(fn, repeat):
+    """Best wall time of `repeat` runs, then tracemalloc peak bytes of one more; returns (seconds, peak, result)."""
+    best = float('inf')
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = fn()
+            best = min(best, time.perf_counter() - start)
+        tracemalloc.start()
+        try:
+            fn()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return best, peak, result
+
+
+def run_stages(directory, date, repeat=3):
+    """Time each pipeline stage on the fixtures in directory.
+
+    Returns one dict per stage: name, items processed, seconds, items/s and peak bytes.
+    """
+    results = []
+
+    def stage(name, fn, items):
+        seconds, peak, result = measure(fn, repeat)
+        count = items(result)
+        results.append({'stage': name, 'items': count, 'seconds': seconds,
+                        'items_per_s': count / seconds if seconds else float('inf'), 'peak_bytes': peak})
+        return result
+
+    inputs = stage('file discovery', lambda: t1.discover_inputs(directory, date),
+                   lambda r: sum(1 for path in r.values() if isinstance(path, str)))
+    raw = stage('csv load', lambda: (t1.read_csv_typed(inputs['positions'], t1.POSITIONS_SCHEMA),
+                                     t1.read_csv_typed(inputs['collar'], t1.COLLAR_SCHEMA),
+                                     t1.read_csv_typed(inputs['stock_codes'], t1.STOCK_CODES_SCHEMA)),
+                lambda r: sum(len(frame) for frame in r))
+    legs = stage('symbol parsing', lambda: t1.parse_instruments(raw[0]['Instrument']), len)
+    df = raw[0].join(legs)
+    greeks = stage('option pricing', lambda: t1.option_greeks(df, t1.valuation_time(date)), len)
+    priced = df.join(greeks)
+    stage('main report', lambda: t1.build_main_report(priced), lambda r: len(df))
+    stage('ce filter', lambda: t1.build_ce_filter(priced), lambda r: len(df))
+    stage('movement block', lambda: t1.build_movement(priced), lambda r: len(df))
+    stage('scenario grid', lambda: t1.scenario_pnl(priced, t1.scenario_moves()), lambda r: r[1].size)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        reference = t1.load_reference(inputs, directory, use_cache=False, history=False)
+        tables = t1.build_tables(df, reference)
+    codes = reference['matcher']['codes']
+    stockcodes = set(tables['main']['stockcode']) | set(tables['watchlist_not_positions']['stockcode'])
+
+    def fuzzy():
+        matcher = {'codes': codes, 'index': None, 'cache_path': None, 'cutoff': t1.FUZZY_CUTOFF, 'matches': None}
+        return t1.resolve_matches(stockcodes, matcher)
+
+    stage('fuzzy matching', fuzzy, len)
+    stage('html render', lambda: t1.render_report(tables),
+          lambda r: sum(len(tables[k]) for k in ('main', 'not_in_watchlist', 'ce', 'move', 'watchlist_not_positions')))
+    stage('end to end', lambda: t1.main(directory, os.path.join(directory, 'output.html'), date, use_cache=False,
+                                        history=False),
+          lambda r: len(df))
+    return results
+
+
+# ==== REPORTING ====
+def format_results(size, counts, results):
+    lines = [f"underlyings={size['underlyings']} legs={size['legs']} watchlist={size['watchlist']} "
+             f"stock_codes={size['stock_codes']} (positions rows={counts['positions']})",
+             f"{'stage':<16}{'items':>10}{'ms':>12}{'items/s':>14}{'peak MiB':>11}"]
+    for r in results:
+        lines.append(f"{r['stage']:<16}{r['items']:>10}{r['seconds'] * 1000:>12.2f}"
+                     f"{r['items_per_s']:>14,.0f}{r['peak_bytes'] / 2 ** 20:>11.2f}")
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark each stage of the t1 report on synthetic exports.")
+    parser.add_argument('--underlyings', type=int, nargs='+', default=[200, 1000, 5000],
+                        help="underlyings per run; several values give a scaling table (default: %(default)s)")
+    parser.add_argument('--legs', type=int, default=3, help="legs per underlying, futures included (default: %(default)s)")
+    parser.add_argument('--watchlist', type=int, default=None,
+                        help="watchlist size (default: half the underlyings)")
+    parser.add_argument('--stock-codes', type=int, default=None,
+                        help="broker stock codes (default: five per underlying)")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per stage, best kept (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', metavar='DIR', default=None,
+                        help="write the fixtures under DIR/<underlyings> and keep them")
+    parser.add_argument('--output', default=None, help="also write the results table to this file")
+    parser.add_argument('--json', default=None, help="also write the raw results as JSON to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    date = datetime.date.today()
+    report, raw = [], []
+    for underlyings in args.underlyings:
+        size = {'underlyings': underlyings, 'legs': args.legs,
+                'watchlist': args.watchlist if args.watchlist is not None else underlyings // 2,
+                'stock_codes': args.stock_codes if args.stock_codes is not None else underlyings * 5}
+        with contextlib.ExitStack() as stack:
+            if args.keep:
+                directory = os.path.join(args.keep, str(underlyings))
+            else:
+                directory = stack.enter_context(tempfile.TemporaryDirectory())
+            counts = generate_fixtures(directory, date=date, seed=args.seed, **size)
+            results = run_stages(directory, date, args.repeat)
+        report.append(format_results(size, counts, results))
+        raw.append({'size': size, 'rows': counts, 'stages': results})
+        print(report[-1] + '\n')
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write('\n\n'.join(report) + '\n')
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(raw, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
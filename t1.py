@@ -1,243 +1,1225 @@
 import re
-import pandas as pd
-import numpy as np
-from datetime import datetime
 import os
-import difflib
 import glob
+import sys
+import time
+import argparse
+import contextlib
 import datetime
+import functools
+import hashlib
+import json
+import math
+from collections import Counter, defaultdict
 
-# Define the directory path
-directory = os.path.join("C:\\", "Users", "rohit", "Documents", "stocks")
+# pandas, numpy and difflib are imported inside the functions that need them so that
+# importing this module (scheduler, tests) stays cheap and free of side effects.
 
-# Pattern to match positions.csv or positions(number).csv
-pattern = os.path.join(directory, "positions*.csv")
+DEFAULT_DIRECTORY = os.path.join("C:\\", "Users", "rohit", "Documents", "stocks")
+OUTPUT_HTML = 'output.html'
+CACHE_DIRNAME = '.report_cache'
+HISTORY_DIRNAME = 'history'
+INPUT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+INPUT_CACHE_MAX_AGE_DAYS = 30
+FUZZY_CUTOFF = 0.9
+STREAM_CHUNK_ROWS = 200_000
+LOAD_WORKERS = 4
+SCENARIO_RANGE = (-20.0, 20.0)
+SCENARIO_STEP = 0.5
+RISK_FREE_RATE = 0.065
+MARKET_CLOSE = datetime.time(15, 30)
+IV_BOUNDS = (1e-4, 5.0)
+IV_TOLERANCE = 1e-6
+IV_MAX_ITERATIONS = 100
+RUN_LOG_NAME = 'report_runs.jsonl'
+
+
+# ==== INSTRUMENTATION ====
+# Code inside record_run() is one recorded run; stage() blocks within it record their wall
+# time and memory. Outside a recorded run both cost nothing.
+_run = None
+_profiling = False  # set by cli() around a --profile run
+
+
+def peak_rss():
+    """Peak resident memory of this process in bytes, or None where the platform does not report it."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Time a named pipeline stage.
+
+    With tracemalloc running, the stage's peak Python allocations above what was already
+    allocated when it started are recorded too. That peak is process-wide, so it is only
+    meaningful for stages that do not overlap; load_pool() loads serially while tracing.
+    """
+    if _run is None:
+        yield
+        return
+    import tracemalloc
 
-# Get all files matching the pattern
-matching_files = glob.glob(pattern)
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _run['stages'].append({
+            'stage': name,
+            'seconds': time.perf_counter() - start,
+            'peak_rss': peak_rss(),
+            'traced_peak': tracemalloc.get_traced_memory()[1] - baseline if tracing else None,
+        })
+
+
+def note(**fields):
+    """Attach fields (input paths, table sizes...) to the run being recorded."""
+    if _run is not None:
+        _run.update(fields)
+
+
+def note_frames(**frames):
+    """Record the rows and deep memory footprint (bytes) of named frames in the run being recorded."""
+    if _run is not None:
+        _run.setdefault('frames', {}).update({
+            name: {'rows': len(frame), 'bytes': int(frame.memory_usage(index=True, deep=True).sum())}
+            for name, frame in frames.items()
+        })
+
+
+@contextlib.contextmanager
+def record_run(log_path=None, **fields):
+    """Record the stages run inside the block as one run.
+
+    On exit a summary table is printed and the run is appended to log_path as one JSON line.
+    """
+    global _run
+    outer = _run
+    _run = dict(fields, started=datetime.datetime.now().isoformat(timespec='seconds'), pid=os.getpid(), stages=[])
+    start = time.perf_counter()
+    try:
+        yield _run
+    except Exception as e:
+        _run['error'] = repr(e)
+        raise
+    finally:
+        run, _run = _run, outer
+        run['seconds'] = time.perf_counter() - start
+        run['peak_rss'] = peak_rss()
+        print(format_run(run))
+        if log_path:
+            try:
+                with open(log_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(run, default=str) + '\n')
+            except OSError as e:
+                print(f"Error writing run log {log_path}: {e}")
+
+
+def format_run(run):
+    """Summary table of a recorded run: milliseconds and peak memory (MiB) per stage, then
+    the footprint of each frame noted with note_frames()."""
+    traced = any(s['traced_peak'] is not None for s in run['stages'])
+    mib = lambda b: '' if b is None else f'{b / 2 ** 20:.1f}'
+    lines = [f"{'stage':<22}{'ms':>10}{'RSS MiB':>10}" + (f"{'+traced':>10}" if traced else '')]
+    for s in run['stages'] + [{'stage': 'total', 'seconds': run['seconds'], 'peak_rss': run['peak_rss'],
+                               'traced_peak': None}]:
+        lines.append(f"{s['stage']:<22}{s['seconds'] * 1000:>10.1f}{mib(s['peak_rss']):>10}"
+                     + (f"{mib(s['traced_peak']):>10}" if traced else ''))
+    if run.get('frames'):
+        lines.append(f"{'frame':<22}{'rows':>10}{'MiB':>10}")
+        for name, f in run['frames'].items():
+            lines.append(f"{name:<22}{f['rows']:>10}{f['bytes'] / 2 ** 20:>10.2f}")
+    return '\n'.join(lines)
+
+# Instrument names look like RELIANCE25JUNFUT, RELIANCE25JUN1400PE (monthly)
+# or NIFTY2561224500CE (weekly: year, month code, day).
+INSTRUMENT_PATTERN = (
+    r'^(?P<stock>.+?)'
+    r'(?P<expiry>\d{2}(?:[A-Z]{3}|[1-9OND]\d{2}))'
+    r'(?:(?P<strike>\d+(?:\.\d+)?)(?P<option>CE|PE)|(?P<fut>FUT))$'
+)
+LEG_TYPES = ['FUT', 'CE', 'PE']
+
+
+def parse_instruments(instruments):
+    """Parse instrument names into a typed leg table: stock (underlying), expiry, strike, leg.
+
+    stock and expiry are categoricals, so each symbol is stored once however many legs share it.
+    """
+    import pandas as pd
+
+    instruments = instruments.astype(str).str.strip().str.upper()
+    parts = instruments.str.extract(INSTRUMENT_PATTERN)
+    # Anything that is not a recognised F&O contract keeps its leading letters as the stock
+    fallback = instruments.str.extract(r'^([A-Z]+)', expand=False).fillna(instruments)
+    return pd.DataFrame({
+        'stock': pd.Categorical(parts['stock'].fillna(fallback)),
+        'expiry': pd.Categorical(parts['expiry']),
+        'strike': pd.to_numeric(parts['strike']).astype(float),
+        'leg': pd.Categorical(parts['option'].fillna(parts['fut']), categories=LEG_TYPES),
+    }, index=instruments.index)
+
+
+def leg_stats(df):
+    """One row per stock with a future: the first FUT leg's columns plus aggregated CE/PE legs.
+
+    net_delta and net_theta total every leg of the stock, weighted by quantity, from the
+    per-unit Greeks of option_greeks().
+    """
+    fut = df[df['leg'] == 'FUT'].drop_duplicates('stock').set_index('stock')
+    options = (
+        df[df['leg'].isin(['CE', 'PE'])]
+        .groupby(['stock', 'leg'], observed=True)
+        .agg(legs=('Instrument', 'size'), pl=('P&L', 'sum'), qty=('Qty.', 'sum'),
+             avg=('Avg.', 'mean'), ltp=('LTP', 'mean'), strike=('strike', 'mean'))
+        .unstack('leg')
+    )
+    options.columns = [f'{leg.lower()}_{stat}' for stat, leg in options.columns]
+    stats = ['legs', 'pl', 'qty', 'avg', 'ltp', 'strike']
+    options = options.reindex(columns=[f'{leg}_{stat}' for leg in ('ce', 'pe') for stat in stats])
+    return fut.join(options).join(stock_exposure(df)).sort_index()
+
+
+def stock_exposure(df):
+    """net_delta and net_theta per stock: every leg's per-unit Greeks weighted by its quantity."""
+    return (
+        df[['Qty.']].assign(net_delta=df['Qty.'] * df['delta'], net_theta=df['Qty.'] * df['theta'])
+        .groupby(df['stock'], observed=True)[['net_delta', 'net_theta']].sum(min_count=1)
+    )
+
+
+def main_report_rows(df):
+    """MAIN REPORT row for every stock with an open future, in stock order."""
+    import pandas as pd
+
+    s = leg_stats(df)
+    s = s[s['Qty.'] != 0]
+    fut_qty = s['Qty.']
+    fut_avg = s['Avg.']
+    has_ce = s['ce_legs'].notna()
+    has_pe = s['pe_legs'].notna()
+
+    margin_total = fut_qty * fut_avg
+    margin = margin_total.where(margin_total != 0)
+    total_prem = s['pe_pl'].fillna(0) + s['ce_pl'].fillna(0)
+    total_net = s['P&L'] + total_prem
+
+    # Collar strategy max loss/profit, only when the option legs fully offset the future
+    ce_avg = s['ce_avg'].where(has_ce, 0)
+    pe_avg = s['pe_avg'].where(has_pe, 0)
+    max_loss = (fut_qty * (s['pe_strike'] - fut_avg - pe_avg + ce_avg)).where(s['pe_qty'] == fut_qty)
+    max_profit = (fut_qty * (s['ce_strike'] - fut_avg - pe_avg + ce_avg)).where(s['ce_qty'] == -fut_qty)
+
+    return pd.DataFrame({
+        'stockcode': s.index.astype(str),
+        'margin_total': margin_total.to_numpy(),
+        'margin_%': s['Chg.'].to_numpy(),
+        'margin_p/l': s['P&L'].to_numpy(),
+        'total_premium': total_prem.to_numpy(),
+        'total_premium_%': (total_prem / margin * 100).to_numpy(),
+        'total_net': total_net.to_numpy(),
+        'net_%': (total_net / margin * 100).to_numpy(),
+        'max_loss': max_loss.to_numpy(dtype=float),
+        'max_profit': max_profit.to_numpy(dtype=float),
+        'delta': s['net_delta'].to_numpy(dtype=float),
+        'theta': s['net_theta'].to_numpy(dtype=float),
+    })
+
+
+def finish_main_report(rows):
+    """Sort MAIN REPORT rows by total_net and compute the TOTAL footer."""
+    import numpy as np
+
+    df_main = rows.sort_values('total_net', ascending=False)
+    tot_margin = df_main['margin_total'].sum()
+    tot_pl = df_main['margin_p/l'].sum()
+    tot_prem = df_main['total_premium'].sum()
+    tot_net = df_main['total_net'].sum()
+    footer = {
+        'stockcode': 'TOTAL',
+        'margin_total': tot_margin,
+        'margin_%': (tot_pl / tot_margin) * 100 if tot_margin else np.nan,
+        'margin_p/l': tot_pl,
+        'total_premium': tot_prem,
+        'total_premium_%': (tot_prem / tot_margin) * 100 if tot_margin else np.nan,
+        'total_net': tot_net,
+        'net_%': (tot_net / tot_margin) * 100 if tot_margin else np.nan,
+        'max_loss': np.nan,
+        'max_profit': np.nan,
+        'delta': df_main['delta'].sum(),
+        'theta': df_main['theta'].sum(),
+    }
+    return df_main, footer
+
+
+def build_main_report(df):
+    """Compute the MAIN REPORT table and its TOTAL footer for every stock at once."""
+    return finish_main_report(main_report_rows(df))
+
+
+
+def build_movement(df):
+    """Compute the MOVEMENT BLOCK (strike distances and premium moves) for every stock at once."""
+    import pandas as pd
+
+    s = leg_stats(df)
+    s = s[s['Qty.'] != 0]
+    stock_avg = s['Avg.']
+    stock_ltp = s['LTP']
+    has_ce = s['ce_legs'].notna()
+    has_pe = s['pe_legs'].notna()
+
+    ce_point = s['ce_strike'].where(has_ce, 0)
+    pe_point = s['pe_strike'].where(has_pe, 0)
+    move_ce = ((ce_point - stock_avg) / stock_avg * 100).where((ce_point != 0) & (stock_avg != 0), 0)
+    move_pe = ((stock_avg - pe_point) / stock_avg * 100).where((pe_point != 0) & (stock_avg != 0), 0)
+    left_ce = ((ce_point - stock_ltp) / stock_ltp * 100).where((ce_point != 0) & (stock_ltp != 0), 0)
+    left_pe = ((stock_ltp - pe_point) / stock_ltp * 100).where((pe_point != 0) & (stock_ltp != 0), 0)
+
+    avg_ce = s['ce_avg'].where(has_ce, 0)
+    ltp_ce = s['ce_ltp'].where(has_ce, 0)
+    avg_pe = s['pe_avg'].where(has_pe, 0)
+    ltp_pe = s['pe_ltp'].where(has_pe, 0)
+    diff_int = avg_ce - avg_pe
+    ltp_diff = (avg_ce - ltp_ce).where(avg_ce > 0, 0) + (ltp_pe - avg_pe).where(avg_pe > 0, 0)
+
+    premium_pct = (diff_int / stock_avg * 100).where(stock_avg != 0, 0)
+    current_pct = (ltp_diff / stock_avg * 100).where(stock_avg != 0, 0)
+    left_ce_prem = (left_ce + premium_pct).where(ce_point != 0, 100)
+    left_pe_prem = left_pe + premium_pct
+
+    return pd.DataFrame({
+        'stockcode': s.index.astype(str),
+        'ce_point': ce_point,
+        'pe_point': pe_point,
+        'stock_chg_%': s['Chg.'],
+        'stock_avg': stock_avg,
+        'stock_ltp': stock_ltp,
+        'left ce (%)': left_ce,
+        'left pe (%)': left_pe,
+        'ltp ce': ltp_ce,
+        'ltp pe': ltp_pe,
+        'avg ce': avg_ce,
+        'avg_pe': avg_pe,
+        'current % ': current_pct,
+        'premium %': premium_pct,
+        'diff %': current_pct - premium_pct,
+        'left ce prem (%)': left_ce_prem,
+        'left pe prem (%)': left_pe_prem,
+        'move ce (%)': move_ce,
+        'move pe (%)': move_pe,
+        'delta': s['net_delta'],
+        'theta': s['net_theta'],
+    }).reset_index(drop=True)
+
+
+# ==== SCENARIOS ====
+def scenario_moves(low=SCENARIO_RANGE[0], high=SCENARIO_RANGE[1], step=SCENARIO_STEP):
+    """Underlying price moves in percent from low to high inclusive, step apart."""
+    import numpy as np
+
+    if step <= 0 or high < low:
+        raise ValueError(f"Invalid scenario grid {low}..{high} step {step}")
+    return np.round(low + step * np.arange(math.floor((high - low) / step + 1e-9) + 1), 10)
+
+
+def scenario_pnl(df, moves):
+    """P&L at expiry of every stock with an open future, for each underlying price move.
+
+    The underlying is moved from its future's LTP, and every FUT, CE and PE leg is valued at
+    its own strike against its Avg. entry price, all in one (legs x moves) array. Returns
+    (stocks, matrix): the stocks in order and one row of P&L per stock, one column per move.
+    """
+    import numpy as np
+
+    fut = df[df['leg'] == 'FUT'].drop_duplicates('stock').set_index('stock')
+    fut = fut[fut['Qty.'] != 0].sort_index()
+    stock = fut.index.get_indexer(df['stock'])
+    keep = (stock >= 0) & df['leg'].notna().to_numpy()
+    legs, stock = df[keep], stock[keep]
+    if legs.empty:
+        return fut.index, np.zeros((0, len(moves)))
+
+    prices = fut['LTP'].to_numpy(dtype=float)[stock, None] * (1 + np.asarray(moves, dtype=float) / 100)
+    strike = legs['strike'].to_numpy(dtype=float)[:, None]
+    kind = legs['leg'].cat.codes.to_numpy()[:, None]
+    value = np.where(kind == LEG_TYPES.index('FUT'), prices,
+                     np.where(kind == LEG_TYPES.index('CE'), np.maximum(prices - strike, 0),
+                              np.maximum(strike - prices, 0)))
+    pnl = (value - legs['Avg.'].to_numpy(dtype=float)[:, None]) * legs['Qty.'].fillna(0).to_numpy(dtype=float)[:, None]
+
+    # Sum the legs of each stock: sort by stock and add up each run of rows
+    order = np.argsort(stock, kind='stable')
+    stock = stock[order]
+    starts = np.flatnonzero(np.r_[True, stock[1:] != stock[:-1]])
+    return fut.index, np.add.reduceat(pnl[order], starts, axis=0)
+
+
+def build_scenarios(df, moves):
+    """Price scenario table: worst and best expiry P&L per stock and one column per move.
+
+    Rows are sorted worst first; the footer holds the portfolio total for each move.
+    """
+    import pandas as pd
+
+    stocks, pnl = scenario_pnl(df, moves)
+    labels = [f'{move:+g}%' for move in moves]
+    df_scenarios = pd.concat([
+        pd.DataFrame({'stockcode': stocks.astype(str), 'worst': pnl.min(axis=1), 'best': pnl.max(axis=1)}),
+        pd.DataFrame(pnl, columns=labels),
+    ], axis=1).sort_values('worst', kind='stable').reset_index(drop=True)
+    total = pnl.sum(axis=0)
+    footer = {'stockcode': 'TOTAL', 'worst': total.min(), 'best': total.max()}
+    footer.update(zip(labels, total))
+    return df_scenarios, footer
+
+
+# ==== OPTION PRICING ====
+# Options are priced with Black-76 off their stock's future, so no spot price or dividend
+# yield is needed. Everything is computed on whole arrays of legs at once.
+MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+WEEKLY_MONTHS = {'O': 10, 'N': 11, 'D': 12}
+
+
+def expiry_date(code):
+    """Expiry date of a parsed expiry code, or None if it is not a valid date.
+
+    Weekly codes carry the day (25612 is 12 June 2025). Monthly contracts (25JUN) expire
+    on the last Tuesday of the month, the last Thursday before September 2025. Exchange
+    holidays are not taken into account.
+    """
+    try:
+        year = 2000 + int(code[:2])
+        if code[2:] in MONTHS:
+            month = MONTHS.index(code[2:]) + 1
+            weekday = 1 if (year, month) >= (2025, 9) else 3
+            last = datetime.date(year + month // 12, month % 12 + 1, 1) - datetime.timedelta(days=1)
+            return last - datetime.timedelta(days=(last.weekday() - weekday) % 7)
+        return datetime.date(year, WEEKLY_MONTHS.get(code[2]) or int(code[2]), int(code[3:]))
+    except (TypeError, ValueError):
+        return None
+
+
+def valuation_time(date):
+    """Now for today's report, the market close for a report on any other date."""
+    now = datetime.datetime.now()
+    return now if date == now.date() else datetime.datetime.combine(date, MARKET_CLOSE)
+
+
+def norm_pdf(x):
+    import numpy as np
+
+    return np.exp(-0.5 * x * x) / math.sqrt(2 * math.pi)
+
+
+def norm_cdf(x):
+    """Standard normal CDF from a rational approximation of erfc (relative error below 1.2e-7)."""
+    import numpy as np
+
+    z = np.abs(x) / math.sqrt(2)
+    t = 1 / (1 + 0.5 * z)
+    erfc = t * np.exp(-z * z - 1.26551223 + t * (1.00002368 + t * (0.37409196 + t * (0.09678418 + t * (
+        -0.18628806 + t * (0.27886807 + t * (-1.13520398 + t * (1.48851587 + t * (-0.82215223 + t * 0.17087277)))))))))
+    return np.where(x >= 0, 1 - 0.5 * erfc, 0.5 * erfc)
+
+
+def black76(forward, strike, years, sigma, rate, call):
+    """Black-76 option prices; returns (price, d1)."""
+    import numpy as np
+
+    sqrt_t = np.sqrt(years)
+    d1 = (np.log(forward / strike) + 0.5 * sigma * sigma * years) / (sigma * sqrt_t)
+    d2 = d1 - sigma * sqrt_t
+    price = np.exp(-rate * years) * np.where(call, forward * norm_cdf(d1) - strike * norm_cdf(d2),
+                                             strike * norm_cdf(-d2) - forward * norm_cdf(-d1))
+    return price, d1
+
+
+def implied_vol(price, forward, strike, years, rate, call):
+    """Black-76 implied volatility of every option at once.
+
+    All options take Newton steps together, each falling back to bisection when its step
+    leaves the bracket known to hold its root, until every price is matched within
+    IV_TOLERANCE. NaN where the price is outside the no-arbitrage bounds or no volatility
+    within IV_BOUNDS matches it.
+    """
+    import numpy as np
+
+    discount = np.exp(-rate * years)
+    intrinsic = discount * np.maximum(np.where(call, forward - strike, strike - forward), 0)
+    valid = ((years > 0) & (forward > 0) & (strike > 0)
+             & (price > intrinsic) & (price < discount * np.where(call, forward, strike)))
+    lo = np.full(price.shape, IV_BOUNDS[0])
+    hi = np.full(price.shape, IV_BOUNDS[1])
+    # Brenner-Subrahmanyam at-the-money estimate as the starting point
+    sigma = np.clip(np.nan_to_num(np.sqrt(2 * math.pi / years) * price / (discount * forward), nan=0.3), lo, hi)
+    sigma = np.where(valid, sigma, 0.3)
+    for _ in range(IV_MAX_ITERATIONS):
+        model, d1 = black76(forward, strike, years, sigma, rate, call)
+        diff = np.where(valid, model - price, 0)
+        active = np.abs(diff) > IV_TOLERANCE
+        if not active.any():
+            break
+        hi = np.where(diff > 0, sigma, hi)
+        lo = np.where(diff < 0, sigma, lo)
+        step = sigma - diff / (discount * forward * norm_pdf(d1) * np.sqrt(years))
+        sigma = np.where(active, np.where((step > lo) & (step < hi), step, (lo + hi) / 2), sigma)
+    return np.where(valid & ~active, sigma, np.nan)
+
+
+def option_greeks(df, valuation, rate=RISK_FREE_RATE):
+    """Implied volatility and Greeks per unit of every leg, as of the valuation datetime.
+
+    Each option is priced off the future of the same stock and expiry, or the stock's first
+    future. Columns: iv, delta, gamma, vega (per volatility point) and theta (per calendar
+    day). Futures have delta 1 and theta 0. An option at or below its intrinsic value, or
+    past expiry, gets the zero-volatility limit; one with no underlying price is left NaN.
+    """
+    import numpy as np
+    import pandas as pd
+
+    greeks = pd.DataFrame(np.nan, index=df.index, columns=['iv', 'delta', 'gamma', 'vega', 'theta'])
+    is_fut = (df['leg'] == 'FUT').to_numpy()
+    is_option = df['leg'].isin(['CE', 'PE']).to_numpy()
+    greeks.loc[is_fut, ['delta', 'theta']] = [1.0, 0.0]
+    options = df[is_option]
+    if options.empty:
+        return greeks
+
+    futures = df[is_fut]
+    same_expiry = futures.drop_duplicates(['stock', 'expiry']).set_index(['stock', 'expiry'])['LTP']
+    first = futures.drop_duplicates('stock').set_index('stock')['LTP']
+    forward = same_expiry.reindex(pd.MultiIndex.from_arrays([options['stock'], options['expiry']])).to_numpy(dtype=float)
+    forward = np.where(np.isnan(forward), first.reindex(options['stock']).to_numpy(dtype=float), forward)
+
+    expiries = options['expiry'].astype(object).map({code: expiry_date(code) for code in options['expiry'].dropna().unique()})
+    closes = pd.to_datetime(expiries.map(lambda d: datetime.datetime.combine(d, MARKET_CLOSE) if d else None))
+    years = ((closes - pd.Timestamp(valuation)).dt.total_seconds() / (365 * 86400)).to_numpy(dtype=float)
+    strike = options['strike'].to_numpy(dtype=float)
+    price = options['LTP'].to_numpy(dtype=float)
+    call = (options['leg'] == 'CE').to_numpy()
+
+    with np.errstate(all='ignore'):
+        iv = implied_vol(price, forward, strike, years, rate, call)
+        _, d1 = black76(forward, strike, years, iv, rate, call)
+        discount = np.exp(-rate * np.maximum(years, 0))
+        pdf = norm_pdf(d1)
+        sqrt_t = np.sqrt(years)
+        delta = discount * np.where(call, norm_cdf(d1), norm_cdf(d1) - 1)
+        gamma = discount * pdf / (forward * iv * sqrt_t)
+        vega = discount * forward * pdf * sqrt_t / 100
+        theta = (rate * price - discount * forward * pdf * iv / (2 * sqrt_t)) / 365
+
+        # Zero-volatility limit: the option moves one for one with the future while in the money
+        itm = np.where(call, forward > strike, forward < strike)
+        flat = np.isnan(iv) & ~np.isnan(forward) & ~np.isnan(years) & ~np.isnan(price) & (
+            (years <= 0) | (price <= discount * np.maximum(np.where(call, forward - strike, strike - forward), 0)))
+        delta = np.where(flat, discount * np.where(call, 1.0, -1.0) * itm, delta)
+        gamma = np.where(flat, 0, gamma)
+        vega = np.where(flat, 0, vega)
+        theta = np.where(flat, np.where(years > 0, rate * price / 365, 0), theta)
+
+    greeks.loc[is_option] = np.column_stack([iv, delta, gamma, vega, theta])
+    return greeks
+
+
+# ==== FUZZY MATCHING ====
+def file_digest(path):
+    """SHA-256 of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def bigrams(word):
+    return Counter(word[i:i + 2] for i in range(len(word) - 1))
+
+
+def build_fuzzy_index(codes):
+    """Index stock codes by length and bigram so a lookup only scores plausible candidates."""
+    codes = list(dict.fromkeys(codes))
+    by_length = defaultdict(list)
+    postings = defaultdict(list)
+    for i, code in enumerate(codes):
+        by_length[len(code)].append(i)
+        for gram, count in bigrams(code).items():
+            postings[gram].append((i, count))
+    return {'codes': codes, 'by_length': by_length, 'postings': postings}
+
+
+def fuzzy_match(index, word, cutoff=FUZZY_CUTOFF):
+    """Best close match for word; same result as difflib.get_close_matches(word, codes, n=1, cutoff)."""
+    import difflib
+
+    codes = index['codes']
+    la = len(word)
+    # ratio = 2M/T >= cutoff needs 2 * min(la, lb) >= cutoff * (la + lb)
+    lengths = range(math.ceil(la * cutoff / (2 - cutoff) - 1e-9), math.floor(la * (2 - cutoff) / cutoff + 1e-9) + 1)
+
+    # M >= cutoff*T/2 matched characters lie in at most T - 2M + 1 matching blocks,
+    # so both words share at least M - blocks >= (1.5*cutoff - 1)*T - 1 bigrams.
+    shared = defaultdict(int)
+    for gram, count in bigrams(word).items():
+        for i, c in index['postings'].get(gram, ()):
+            shared[i] += min(count, c)
+    candidates = []
+    for lb in lengths:
+        needed = (1.5 * cutoff - 1) * (la + lb) - 1 - 1e-9
+        if needed <= 0:
+            candidates.extend(codes[i] for i in index['by_length'].get(lb, ()))
+        else:
+            candidates.extend(codes[i] for i in index['by_length'].get(lb, ()) if shared.get(i, 0) >= needed)
+    matches = difflib.get_close_matches(word, candidates, n=1, cutoff=cutoff)
+    return matches[0] if matches else None
 
-# Filter files to ensure they match positions.csv or positions(number).csv
-valid_files = [
-    f for f in matching_files
-    if re.match(r'.*positions(\(\d+\))?\.csv$', f)
-]
 
-# Find the most recently created file and delete others
-if valid_files:
-    input_path = max(valid_files, key=os.path.getctime)
-    print(f"Keeping latest file: {input_path}")
+def read_match_cache(cache_path, cutoff):
+    if not cache_path or not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            data = json.load(f)
+        return data['matches'] if data.get('cutoff') == cutoff else {}
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Ignoring unreadable match cache {cache_path}: {e}")
+        return {}
+
+
+def resolve_matches(stockcodes, matcher):
+    """Map each stock code to its closest broker code (or None), reusing previously resolved matches.
+
+    Matches are kept on the matcher and in a cache file whose name carries the stock-codes
+    file hash, so a new codes file starts a fresh cache.
+    """
+    cutoff = matcher['cutoff']
+    if matcher['matches'] is None:
+        matcher['matches'] = read_match_cache(matcher['cache_path'], cutoff)
+    cached = matcher['matches']
+
+    missing = [code for code in stockcodes if code not in cached]
+    if missing and matcher['codes']:
+        if matcher['index'] is None:
+            matcher['index'] = build_fuzzy_index(matcher['codes'])
+        cached.update({code: fuzzy_match(matcher['index'], code, cutoff) for code in missing})
+    else:
+        cached.update({code: None for code in missing})
+
+    cache_path = matcher['cache_path']
+    if missing and cache_path:
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp = f'{cache_path}.{os.getpid()}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'cutoff': cutoff, 'matches': cached}, f)
+            os.replace(tmp, cache_path)
+        except OSError as e:
+            print(f"Error writing match cache {cache_path}: {e}")
+    return {code: cached[code] for code in stockcodes}
+
+
+# ==== HIGHLIGHT RULES ====
+# name -> (CSS class, target, predicate). The target is a list of columns (by name, or by
+# position for the "second column" cell), or ROW for a class on the whole <tr>.
+# Predicates see the whole frame, its normalised stock codes and the run's stock lists,
+# and return one boolean per row.
+ROW = None
+HIGHLIGHT_RULES = {
+    'highlight': ('highlight', ROW,
+                  lambda f, codes, ctx: codes.isin(ctx['highlights'])),
+    'high_value': ('high_value', ['stockcode'],
+                   lambda f, codes, ctx: codes.isin(ctx['high_value'])),
+    'not_in_watchlist': ('not_in_watchlist', ['stockcode'],
+                         lambda f, codes, ctx: codes.isin(ctx['not_in_watchlist'])),
+    'recent_match': ('recent_match', [1],
+                     lambda f, codes, ctx: codes.isin(ctx['matched'])),
+    'margin_impact': ('highlight_cell_main', ['margin_%', 'total_premium_%'],
+                      lambda f, codes, ctx: f['margin_%'].abs() < 0.6 * f['total_premium_%']),
+    'net_highlight': ('net_highlight', ['net_%'],
+                      lambda f, codes, ctx: f['net_%'] >= 2),
+    'collar_credit': ('collar_credit', ['initial_net_premium'],
+                      lambda f, codes, ctx: f['initial_net_premium'] < 0),
+    'premium_move': ('highlight_cell_move', ['current % ', 'premium %'],
+                     lambda f, codes, ctx: f['current % '] > f['premium %'] + 0.25),
+    'ce_near_strike': ('highlight_cell_move', ['left ce (%)'],
+                       lambda f, codes, ctx: (f['ce_point'] != 0) & (f['left ce (%)'] < 0.5)),
+}
+STOCK_RULES = ['high_value', 'recent_match']
+NOT_IN_WATCHLIST_RULES = ['high_value', 'not_in_watchlist', 'recent_match', 'collar_credit']
+MAIN_RULES = NOT_IN_WATCHLIST_RULES + ['highlight', 'margin_impact', 'net_highlight']
+MOVE_RULES = STOCK_RULES + ['premium_move', 'ce_near_strike']
+# Rules applied to each table returned by build_tables()
+TABLE_RULES = {
+    'main': MAIN_RULES,
+    'not_in_watchlist': NOT_IN_WATCHLIST_RULES,
+    'ce': STOCK_RULES,
+    'move': MOVE_RULES,
+    'watchlist_not_positions': STOCK_RULES,
+    'scenarios': STOCK_RULES,
+}
+# Footer of each table that has one
+TABLE_FOOTERS = {'main': 'footer', 'move': 'move_footer', 'scenarios': 'scenario_footer'}
+
+
+def highlight_masks(frame, rule_names, context):
+    """Evaluate the named highlight rules over a frame as boolean row masks.
+
+    Rules whose target columns are not in the frame are skipped.
+    """
+    import numpy as np
+
+    codes = frame['stockcode'].astype(str).str.upper().str.strip()
+    masks = {}
+    for name in rule_names:
+        _, target, predicate = HIGHLIGHT_RULES[name]
+        if target is not ROW and any(isinstance(c, str) and c not in frame.columns for c in target):
+            continue
+        masks[name] = np.asarray(predicate(frame, codes, context), dtype=bool)
+    return masks
+
+
+def highlight_classes(frame, masks):
+    """Turn rule masks into per-column cell classes and per-row classes."""
+    import numpy as np
+
+    n = len(frame)
+    cells = {}
+    rows = np.full(n, '', dtype=object)
+    for name, mask in masks.items():
+        css, target, _ = HIGHLIGHT_RULES[name]
+        targets = [rows] if target is ROW else [
+            cells.setdefault(frame.columns[c] if isinstance(c, int) else c, np.full(n, '', dtype=object))
+            for c in target]
+        for classes in targets:
+            classes[mask] = np.where(classes[mask] == '', css, classes[mask] + ' ' + css)
+    return cells, rows
+
+
+def highlight_flags(frame, masks):
+    """Encode rule masks as a legend of [column position, class] pairs plus one bitmask per row.
+
+    Bit i of a row's flags is set when legend[i] applies to it; position -1 is the <tr> itself.
+    """
+    import numpy as np
+
+    legend = []
+    flags = np.zeros(len(frame), dtype=np.int64)
+    for name, mask in masks.items():
+        css, target, _ = HIGHLIGHT_RULES[name]
+        positions = [-1] if target is ROW else [c if isinstance(c, int) else frame.columns.get_loc(c) for c in target]
+        for position in positions:
+            if [position, css] not in legend:
+                legend.append([position, css])
+            flags[mask] |= 1 << legend.index([position, css])
+    return legend, flags
+
+
+def format_column(values):
+    """Format a column for display: floats to two decimals, everything else as text."""
+    import numpy as np
+
+    if values.dtype.kind == 'f':
+        return np.char.mod('%.2f', values.to_numpy()).tolist()
+    return [f'{v:.2f}' if isinstance(v, float) else str(v) for v in values.tolist()]
+
+
+def filter_metadata(frame, col_types, values):
+    """Per-column filter data for the page: the distinct displayed strings of 'string'
+    columns and the min/max of 'numeric' ones."""
+    import numpy as np
+    import pandas as pd
+
+    columns = []
+    for c in frame.columns:
+        if col_types[c] == 'numeric':
+            numbers = pd.to_numeric(frame[c], errors='coerce').to_numpy(dtype=float)
+            numbers = numbers[np.isfinite(numbers)]
+            columns.append({'type': 'numeric',
+                            'min': round(float(numbers.min()), 2) if len(numbers) else None,
+                            'max': round(float(numbers.max()), 2) if len(numbers) else None})
+        else:
+            columns.append({'type': col_types[c], 'values': sorted({v.strip() for v in values[c]} - {''})})
+    return {'columns': columns}
+
+
+def render_table(table_id, title, frame, col_types, masks=None, footer=None, json_rows=False):
+    """Render a frame as a report table section, one column at a time.
+
+    col_types maps column -> data-type ('string' or 'numeric') used by the filters,
+    masks are the highlight rule masks from highlight_masks() and footer maps
+    column -> footer value. With json_rows the body is left empty and the rows travel
+    as one JSON array with highlight_flags(), for DataTables to render on demand.
+    """
+    values = {c: format_column(frame[c]) for c in frame.columns}
+    if json_rows:
+        legend, flags = highlight_flags(frame, masks or {})
+        payload = json.dumps({
+            'rows': [list(row) for row in zip(*values.values())],
+            'legend': legend,
+            'flags': flags.tolist(),
+        }, separators=(',', ':')).replace('</', '<\\/')
+        body = '<tbody></tbody>'
+        data = f'<script type="application/json" class="table-data">{payload}</script>'
+    else:
+        cell_classes, row_classes = highlight_classes(frame, masks or {})
+        columns = []
+        for c in frame.columns:
+            classes = cell_classes.get(c)
+            if classes is None:
+                columns.append([f'<td class="">{v}</td>' for v in values[c]])
+            else:
+                columns.append([f'<td class="{k}">{v}</td>' for k, v in zip(classes, values[c])])
+        rows = [f'<tr class="{k}">' + ''.join(cells) + '</tr>' for k, *cells in zip(row_classes, *columns)]
+        body = '<tbody>' + ''.join(rows) + '</tbody>'
+        data = ''
+    filters = json.dumps(filter_metadata(frame, col_types, values), separators=(',', ':')).replace('</', '<\\/')
+    data += f'<script type="application/json" class="table-filters">{filters}</script>'
+
+    html = [f'<div class="table-section"><h2>{title}</h2><table id="{table_id}">']
+    html.append('<thead><tr>' + ''.join(f'<th data-type="{col_types[c]}">{c}</th>' for c in frame.columns) + '</tr></thead>')
+    html.append(body)
+    if footer is not None:
+        html.append('<tfoot><tr class="total">' + ''.join(
+            f'<td>{footer[c]:.2f}</td>' if isinstance(footer[c], float) else f'<td>{footer[c]}</td>'
+            for c in frame.columns) + '</tr></tfoot>')
+    html.append('</table>' + data + '</div>')
+    return ''.join(html)
+
+
+def find_latest(directory, stem, label, log=print):
+    """Return the newest '<stem>.csv' or '<stem>(N).csv' download in directory, deleting older copies.
+
+    Returns None when there is no matching file. Messages go to log.
+    """
+    pattern = os.path.join(glob.escape(directory), f"{glob.escape(stem)}*.csv")
+    valid_files = [
+        f for f in glob.glob(pattern)
+        if re.match(rf'.*{re.escape(stem)}(\(\d+\))?\.csv$', f)
+    ]
+    if not valid_files:
+        log(f"No files matching '{stem}*.csv' found in the directory.")
+        return None
 
-    # Delete all other matching files
+    latest = max(valid_files, key=os.path.getctime)
+    log(f"Keeping latest {label} file: {latest}")
     for file in valid_files:
-        if file != input_path:
+        if file != latest:
             try:
                 os.remove(file)
-                print(f"Deleted file: {file}")
+                log(f"Deleted {file}")
             except OSError as e:
-                print(f"Error deleting file {file}: {e}")
-else:
-    raise FileNotFoundError("No files matching 'positions*.csv' found in the directory.")
-
-
-INPUT_CSV = input_path
-OUTPUT_HTML = 'output.html'
-
-def extract_stock(instr):
-    """Extract stock code from instrument name."""
-    m = re.match(r'^([A-Za-z]+)', instr)
-    return m.group(1) if m else instr
-
-def main():
-    """Process positions.csv, generate financial metrics, and output to HTML."""
-    # Set watchlist file path dynamically using os.path.join
-    current_date = datetime.date.today()
-    month = current_date.strftime("%B")
-    day = current_date.day
-    year = current_date.year
-    # Set base path and output path
-    base_path = r"C:\Users\rohit\Documents\stocks"
-
-
-    # Set today's date dynamically
-    today = datetime.date.today()
-    date_str = today.strftime("%B %d, %Y")
-
-    # Define the directory path
-    folder_path = base_path
-
-    # Patterns to match Collar_{date_str}*.csv and ALL PARAMETERS_{date_str}*.csv
-    collar_pattern = os.path.join(folder_path, f"Collar_{date_str}*.csv")
-    params_pattern = os.path.join(folder_path, f"ALL PARAMETERS_{date_str}*.csv")
-
-    # Get all files matching the patterns
-    collar_files = glob.glob(collar_pattern)
-    params_files = glob.glob(params_pattern)
-
-    # Filter files to match Collar_{date_str}*.csv or Collar_{date_str}(number).csv
-    valid_collar_files = [
-        f for f in collar_files
-        if re.match(rf'.*Collar_{re.escape(date_str)}(\(\d+\))?\.csv$', f)
-    ]
-
-    # Filter files to match ALL PARAMETERS_{date_str}*.csv or ALL PARAMETERS_{date_str}(number).csv
-    valid_params_files = [
-        f for f in params_files
-        if re.match(rf'.*ALL PARAMETERS_{re.escape(date_str)}(\(\d+\))?\.csv$', f)
-    ]
+                log(f"Error deleting file {file}: {e}")
+    return latest
+
+
+def load_pool():
+    """Thread pool for loading inputs, or None to load them serially under --profile or
+    --trace-memory: cProfile only sees the thread it runs in, and overlapping stages would
+    share tracemalloc's process-wide peak."""
+    import tracemalloc
+    from concurrent.futures import ThreadPoolExecutor
+
+    if _profiling or tracemalloc.is_tracing():
+        return None
+    return ThreadPoolExecutor(LOAD_WORKERS)
+
+
+def run_concurrently(pool, tasks):
+    """Run {key: (label, fn, *args)} on a thread pool, or one after another when pool is None.
+
+    Returns {key: result}. Every task that fails is reported with its label before the
+    first failure is re-raised, so one bad export does not hide another.
+    """
+    futures = {key: pool.submit(fn, *args) for key, (label, fn, *args) in tasks.items()} if pool else None
+    results, errors = {}, []
+    for key, (label, fn, *args) in tasks.items():
+        try:
+            results[key] = futures[key].result() if futures else fn(*args)
+        except Exception as e:
+            print(f"Error loading {label}: {e}")
+            errors.append(e)
+    if errors:
+        raise errors[0]
+    return results
+
+
+def discover_inputs(directory, date, positions=True, pool=None):
+    """Locate the positions, Collar, ALL PARAMETERS and stock codes files for a report date.
+
+    positions=False skips (and leaves untouched) the positions exports, for batch runs
+    that are given their positions files explicitly. With a pool the folder is searched
+    for each export concurrently.
+    """
+    date_str = date.strftime("%B %d, %Y")
+    searches = {
+        'positions': ('positions', 'positions'),
+        'collar': (f'Collar_{date_str}', 'Collar'),
+        'params': (f'ALL PARAMETERS_{date_str}', 'ALL PARAMETERS'),
+    }
+    if not positions:
+        del searches['positions']
+    # Each search logs into its own list, printed in a fixed order once all are done
+    logs = {key: [] for key in searches}
+    try:
+        found = run_concurrently(pool, {key: (f"{stem}*.csv", find_latest, directory, stem, label, logs[key].append)
+                                        for key, (stem, label) in searches.items()})
+    finally:
+        for lines in logs.values():
+            for line in lines:
+                print(line)
+    return {
+        'date': date,
+        'positions': found.get('positions'),
+        'collar': found['collar'],
+        'params': found['params'],
+        'stock_codes': os.path.join(directory, 'stock_codes.csv'),
+    }
 
-    # Process Collar files: Keep the latest, delete others
-    if valid_collar_files:
-        today_collar = max(valid_collar_files, key=os.path.getctime)
-        print(f"Keeping latest Collar file: {today_collar}")
-        for file in valid_collar_files:
-            if file != today_collar:
-                try:
-                    os.remove(file)
-                    print(f"Deleted {file}")
-                except OSError as e:
-                    print(f"Error deleting file {file}: {e}")
-    else:
-        print(f"No files matching 'Collar_{date_str}*.csv' found in the directory.")
-
-    # Process ALL PARAMETERS files: Keep the latest, delete others
-    if valid_params_files:
-        today_params = max(valid_params_files, key=os.path.getctime)
-        print(f"Keeping latest ALL PARAMETERS file: {today_params}")
-        for file in valid_params_files:
-            if file != today_params:
-                try:
-                    os.remove(file)
-                    print(f"Deleted {file}")
-                except OSError as e:
-                    print(f"Error deleting file {file}: {e}")
-    else:
-        print(f"No files matching 'ALL PARAMETERS_{date_str}*.csv' found in the directory.")
 
+# ==== INPUT SCHEMAS ====
+# Columns the report reads from each export and their dtypes. Names are matched after
+# stripping whitespace; columns missing from a file are simply absent from the frame.
+# float32 holds quantities exactly; prices and P&L stay float64. 'numeric' columns come from
+# screeners that write placeholders such as '-': they are read as text and coerced, so the
+# placeholders become NaN and whole-number scores keep an integer dtype (85, not 85.00).
+POSITIONS_SCHEMA = {
+    'Instrument': 'str',
+    'Qty.': 'float32',
+    'Avg.': 'float64',
+    'LTP': 'float64',
+    'P&L': 'float64',
+    'Chg.': 'float64',
+}
+COLLAR_SCHEMA = {
+    'NSE Code': 'str',
+    'LTP': 'numeric',
+    'Change (%)': 'numeric',
+    'TL Durability Score': 'numeric',
+    'TL Valuation Score': 'numeric',
+    'TL Momentum Score': 'numeric',
+    'Stock Classification': 'category',
+}
+STOCK_CODES_SCHEMA = {
+    'm_stock_code': 'str',
+}
+
+
+def read_csv_typed(path, schema=None):
+    """Read a CSV export with stripped column names, keeping only the schema's columns.
+
+    Uses the multithreaded pyarrow parser when it is installed and falls back to the
+    C parser for files it rejects.
+    """
+    import pandas as pd
+    try:
+        import pyarrow  # noqa: F401
+        engines = ['pyarrow', 'c']
+    except ImportError:
+        engines = ['c']
+
+    kwargs = {}
+    if schema is not None:
+        header = pd.read_csv(path, nrows=0).columns
+        columns = {raw: raw.strip() for raw in header if raw.strip() in schema}
+        kwargs = {'usecols': list(columns),
+                  'dtype': {raw: read_dtype(schema[name]) for raw, name in columns.items()}}
+    for engine in engines:
+        try:
+            df = pd.read_csv(path, engine=engine, **kwargs)
+            break
+        except ValueError:
+            if engine == engines[-1]:
+                raise
+    df.columns = df.columns.str.strip()
+    return coerce_numeric(df, schema)
+
+
+def read_dtype(dtype):
+    """dtype to parse a schema column with; 'numeric' columns are parsed as text."""
+    return 'str' if dtype == 'numeric' else dtype
+
+
+def coerce_numeric(df, schema):
+    """Convert the schema's 'numeric' columns, turning unparseable placeholders into NaN."""
+    import pandas as pd
+    for name, dtype in (schema or {}).items():
+        if dtype == 'numeric' and name in df.columns:
+            df[name] = pd.to_numeric(df[name], errors='coerce')
+    return df
+
+
+# ==== STREAMING INPUT ====
+def read_csv_chunks(path, schema, chunk_rows=STREAM_CHUNK_ROWS, required=()):
+    """read_csv_typed() in chunks of chunk_rows rows, for exports too large to hold in memory.
+
+    Raises ValueError before reading any rows if a column in `required` is missing.
+    """
+    import pandas as pd
+
+    header = pd.read_csv(path, nrows=0).columns
+    columns = {raw: raw.strip() for raw in header if raw.strip() in schema}
+    missing = [name for name in required if name not in columns.values()]
+    if missing:
+        raise ValueError(f"{path} is missing the columns {', '.join(missing)}; "
+                         f"streamed positions and trade logs need {', '.join(required)}")
+    dtype = {raw: read_dtype(schema[name]) for raw, name in columns.items()}
+    with pd.read_csv(path, usecols=list(columns), dtype=dtype, chunksize=chunk_rows) as reader:
+        for chunk in reader:
+            yield coerce_numeric(chunk.rename(columns=columns), schema)
+
+
+def fold_positions(chunks):
+    """Fold positions or trade-log rows into one row per instrument, in first-seen order.
+
+    Quantities and P&L are summed and LTP/Chg. take the latest value. Avg. becomes the
+    average price of the open position, as in the broker's positions export: fills that
+    add to the position are averaged by quantity, fills that reduce it leave it unchanged,
+    and a fill that flips it from long to short (or back) starts again at its own price.
+    Rows are keyed by Product as well when the export has one, and an instrument with a
+    single row is kept as it is, so a compact positions export folds to itself. Only the
+    running per-instrument totals are held in memory, never more than one chunk of raw rows.
+    """
+    import pandas as pd
+
+    totals = None
+    position = {}  # key -> (open quantity, its average price)
+    for chunk in chunks:
+        keys = [chunk[c] for c in ('Product', 'Instrument') if c in chunk]
+        grouped = chunk.groupby(keys, sort=False, dropna=False)
+        part = pd.DataFrame({
+            'rows': grouped.size(),
+            'Qty.': grouped['Qty.'].sum(min_count=1),
+            'Avg.': grouped['Avg.'].last(),
+            'LTP': grouped['LTP'].last(),
+            'P&L': grouped['P&L'].sum(min_count=1),
+            'Chg.': grouped['Chg.'].last(),
+        })
+        if totals is not None:
+            merged = pd.concat([totals, part]).groupby(level=list(range(len(keys))), sort=False, dropna=False)
+            sums = merged[['rows', 'Qty.', 'P&L']].sum(min_count=1)
+            part = merged[['Avg.', 'LTP', 'Chg.']].last().join(sums)
+        totals = part
+
+        # The open average depends on the order of the fills, so it is replayed row by row
+        key_values = zip(*(k.tolist() for k in keys)) if len(keys) > 1 else keys[0].tolist()
+        for key, qty, price in zip(key_values, chunk['Qty.'].tolist(), chunk['Avg.'].tolist()):
+            if not qty or qty != qty or price != price:
+                continue
+            held, avg = position.get(key, (0.0, 0.0))
+            if held == 0 or (held > 0) == (qty > 0):
+                avg = (held * avg + qty * price) / (held + qty)
+            elif abs(qty) > abs(held):
+                avg = price
+            position[key] = (held + qty, avg)
+
+    if totals is None:
+        return pd.DataFrame({name: pd.Series(dtype=dtype) for name, dtype in POSITIONS_SCHEMA.items()})
+    weighted = (totals['rows'] > 1) & (totals['Qty.'] != 0)
+    open_avg = pd.Series([position.get(key, (0.0, float('nan')))[1] for key in totals.index], index=totals.index)
+    totals['Avg.'] = totals['Avg.'].mask(weighted, open_avg)
+    return totals.reset_index()[list(POSITIONS_SCHEMA)]
+
+
+# ==== INPUT CACHE ====
+def read_csv_cached(path, cache_dir=None, schema=None):
+    """read_csv_typed(), cached by file content and schema in Arrow IPC format.
+
+    A cache hit memory-maps the stored columns instead of parsing the CSV. Without
+    pyarrow, or with cache_dir=None, the CSV is simply read.
+    """
+    try:
+        import pyarrow.feather as feather
+    except ImportError:
+        feather = None
+
+    entry = None
+    if cache_dir and feather is not None:
+        key = file_digest(path)
+        if schema is not None:
+            key += '-' + hashlib.sha256(json.dumps(schema, sort_keys=True).encode()).hexdigest()[:12]
+        entry = os.path.join(cache_dir, 'frames', key + '.arrow')
+        if os.path.exists(entry):
+            try:
+                df = feather.read_table(entry, memory_map=True).to_pandas()
+                os.utime(entry)
+                return df
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable cache entry {entry}: {e}")
+
+    df = read_csv_typed(path, schema)
+    if entry is not None:
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            tmp = f'{entry}.{os.getpid()}.tmp'
+            # Uncompressed so later reads can be memory-mapped
+            feather.write_feather(df, tmp, compression='uncompressed')
+            os.replace(tmp, entry)
+            evict_input_cache(os.path.dirname(entry))
+        except (OSError, ValueError, TypeError) as e:
+            print(f"Error caching {path}: {e}")
+    return df
+
+
+def evict_input_cache(frames_dir, max_bytes=INPUT_CACHE_MAX_BYTES, max_age_days=INPUT_CACHE_MAX_AGE_DAYS):
+    """Drop cached frames unused for max_age_days, then the least recently used beyond max_bytes."""
+    with os.scandir(frames_dir) as it:
+        entries = sorted((e.stat().st_mtime, e.stat().st_size, e.path) for e in it if e.name.endswith('.arrow'))
+    cutoff = time.time() - max_age_days * 86400
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, path in entries:
+        if mtime >= cutoff and total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError as e:
+            print(f"Error evicting cache entry {path}: {e}")
+
+
+# ==== LOADING ====
+WATCHLIST_COLUMNS = ['NSE Code', 'LTP', 'Change (%)', 'TL Durability Score', 'TL Valuation Score', 'TL Momentum Score', 'Stock Classification']
+
+
+def load_positions(path, cache_dir=None, chunk_rows=None):
+    """Read a positions export and attach the parsed instrument legs.
+
+    With chunk_rows the export (or a full trade log) is streamed through fold_positions()
+    instead of being loaded whole; it must then have every POSITIONS_SCHEMA column.
+    """
+    with stage('read positions'):
+        if chunk_rows:
+            df = fold_positions(read_csv_chunks(path, dict(POSITIONS_SCHEMA, Product='str'), chunk_rows,
+                                                required=list(POSITIONS_SCHEMA)))
+        else:
+            df = read_csv_cached(path, cache_dir, POSITIONS_SCHEMA)
+    with stage('symbol parsing'):
+        return df.join(parse_instruments(df['Instrument']))
 
 
-    watchlist_path =today_collar
+def load_watchlist(watchlist_path, cache_dir=None):
+    """Read the Collar watchlist along with its stock codes and high-value stocks.
 
-    # Read positions data
-    try:
-        df = pd.read_csv(INPUT_CSV)
-        print(df)
-        df.columns = df.columns.str.strip()
-    except FileNotFoundError:
-        print(f"Error: {INPUT_CSV} not found.")
-        return
-    df['stock'] = df['Instrument'].astype(str).apply(extract_stock)
+    codes holds each row's NSE Code upper-cased and stripped, normalised once here.
+    """
+    import pandas as pd
 
-    # Read watchlist data
     try:
-        watchlist_df = pd.read_csv(watchlist_path)
-        watchlist_df.columns = watchlist_df.columns.str.strip()
-        print("Watchlist columns:", watchlist_df.columns)
-        watchlist_stocks = watchlist_df['NSE Code'].str.upper().str.strip().unique()
+        if watchlist_path is None:
+            raise FileNotFoundError(watchlist_path)
+        watchlist_df = read_csv_cached(watchlist_path, cache_dir, COLLAR_SCHEMA)
+        codes = watchlist_df['NSE Code'].str.upper().str.strip()
+        watchlist_stocks = codes.unique()
         # Identify high-value stocks
         if all(col in watchlist_df.columns for col in ['TL Valuation Score', 'TL Momentum Score', 'TL Durability Score']):
-            high_value_stocks = watchlist_df[
+            high_value_stocks = codes[
                 (watchlist_df['TL Valuation Score'] > 40) &
                 (watchlist_df['TL Momentum Score'] > 50) &
                 (watchlist_df['TL Durability Score'] > 50)
-            ]['NSE Code'].str.upper().str.strip().unique()
+            ].unique()
         else:
             high_value_stocks = []
     except FileNotFoundError:
         print(f"Error: {watchlist_path} not found. Please ensure the file exists at the specified path.")
-        watchlist_df = pd.DataFrame(columns=['NSE Code', 'LTP', 'Change (%)', 'TL Durability Score', 'TL Valuation Score', 'TL Momentum Score', 'Stock Classification'])
+        watchlist_df = pd.DataFrame(columns=WATCHLIST_COLUMNS)
+        codes = pd.Series(dtype=str)
         watchlist_stocks = []
         high_value_stocks = []
     except KeyError as e:
         print(f"Error: Column {e} not found in watchlist. Available columns:", watchlist_df.columns if 'watchlist_df' in locals() else "None")
-        watchlist_df = pd.DataFrame(columns=['NSE Code', 'LTP', 'Change (%)', 'TL Durability Score', 'TL Valuation Score', 'TL Momentum Score', 'Stock Classification'])
+        watchlist_df = pd.DataFrame(columns=WATCHLIST_COLUMNS)
+        codes = pd.Series(dtype=str)
         watchlist_stocks = []
         high_value_stocks = []
+    return {'df': watchlist_df, 'codes': codes, 'stocks': watchlist_stocks, 'high_value': high_value_stocks}
 
-    # ==== MAIN REPORT ====
-    records = []
-    for stock, grp in df.groupby('stock'):
-        futs = grp[grp['Instrument'].str.contains('FUT')]
-        if futs.empty:
-            continue
-        fut = futs.iloc[0]
-        pe_rows = grp[grp['Instrument'].str.contains('PE')]
-        ce_rows = grp[grp['Instrument'].str.contains('CE')]
-
-        if fut['Qty.'] != 0:
-            margin_total = fut['Qty.'] * fut['Avg.']
-            margin_pct = fut['Chg.']
-            margin_pl = fut['P&L']
-            pe_pl = pe_rows['P&L'].sum() if not pe_rows.empty else 0
-            ce_pl = ce_rows['P&L'].sum() if not ce_rows.empty else 0
-            total_prem = pe_pl + ce_pl
-            total_net = margin_pl + total_prem
-            net_pct = (total_net / margin_total) * 100 if margin_total else np.nan
-            prem_pct = (total_prem / margin_total) * 100 if margin_total else np.nan
-
-            # Collar strategy max loss/profit
-            max_loss = np.nan
-            max_profit = np.nan
-            fut_qty = fut['Qty.']
-            if not pe_rows.empty:
-                pe_strikes = [float(m.group(1)) for inst in pe_rows['Instrument'] if (m := re.search(r'(\d+(?:\.\d+)?)PE', inst))]
-                if pe_strikes:
-                    K_pe = np.mean(pe_strikes)
-                    pe_avg = pe_rows['Avg.'].mean()
-                    pe_qty = pe_rows['Qty.'].sum()
-                    if pe_qty == fut_qty:
-                        max_loss = fut_qty * (K_pe - fut['Avg.'] - pe_avg + (ce_rows['Avg.'].mean() if not ce_rows.empty else 0))
-            if not ce_rows.empty:
-                ce_strikes = [float(m.group(1)) for inst in ce_rows['Instrument'] if (m := re.search(r'(\d+(?:\.\d+)?)CE', inst))]
-                if ce_strikes:
-                    K_ce = np.mean(ce_strikes)
-                    ce_avg = ce_rows['Avg.'].mean()
-                    ce_qty = ce_rows['Qty.'].sum()
-                    if ce_qty == -fut_qty:
-                        max_profit = fut_qty * (K_ce - fut['Avg.'] - (pe_rows['Avg.'].mean() if not pe_rows.empty else 0) + ce_avg)
-
-            records.append({
-                'stockcode': stock,
-                'margin_total': margin_total,
-                'margin_%': margin_pct,
-                'margin_p/l': margin_pl,
-                'total_premium': total_prem,
-                'total_premium_%': prem_pct,
-                'total_net': total_net,
-                'net_%': net_pct,
-                'max_loss': max_loss,
-                'max_profit': max_profit
-            })
-
-    df_main = pd.DataFrame(records).sort_values('total_net', ascending=False)
 
-    tot_margin = df_main['margin_total'].sum()
-    tot_pl = df_main['margin_p/l'].sum()
-    tot_prem = df_main['total_premium'].sum()
-    tot_net = df_main['total_net'].sum()
-    footer = {
-        'stockcode': 'TOTAL',
-        'margin_total': tot_margin,
-        'margin_%': (tot_pl / tot_margin) * 100 if tot_margin else np.nan,
-        'margin_p/l': tot_pl,
-        'total_premium': tot_prem,
-        'total_premium_%': (tot_prem / tot_margin) * 100 if tot_margin else np.nan,
-        'total_net': tot_net,
-        'net_%': (tot_net / tot_margin) * 100 if tot_margin else np.nan,
-        'max_loss': np.nan,
-        'max_profit': np.nan
+def load_stock_codes(codes_path, cache_dir, cutoff=FUZZY_CUTOFF):
+    """Read stock_codes.csv into a matcher: broker codes, their fuzzy index (built on first use)
+    and the resolved-match cache. cache_dir=None disables the on-disk caches."""
+    try:
+        stock_codes_df = read_csv_cached(codes_path, cache_dir, STOCK_CODES_SCHEMA)
+        m_stock_codes = stock_codes_df['m_stock_code'].str.upper().str.strip().unique().tolist()
+        cache_path = os.path.join(cache_dir, f'fuzzy_matches_{file_digest(codes_path)[:16]}.json') if cache_dir else None
+    except FileNotFoundError:
+        print("Error: stock_codes.csv not found.")
+        m_stock_codes = []
+        cache_path = None
+    except KeyError:
+        print("Error: 'm_stock_code' column not found in stock_codes.csv.")
+        m_stock_codes = []
+        cache_path = None
+    return {'codes': m_stock_codes, 'index': None, 'cache_path': cache_path, 'cutoff': cutoff, 'matches': None}
+
+
+def prepare_matcher(matcher):
+    """Build the matcher's fuzzy index and read its match cache now rather than on first use."""
+    if matcher['codes'] and matcher['index'] is None:
+        matcher['index'] = build_fuzzy_index(matcher['codes'])
+    if matcher['matches'] is None:
+        matcher['matches'] = read_match_cache(matcher['cache_path'], matcher['cutoff'])
+    return matcher
+
+
+def load_matcher(codes_path, cache_dir):
+    """load_stock_codes() followed by prepare_matcher(), for loads that overlap the positions parse."""
+    matcher = load_stock_codes(codes_path, cache_dir)
+    with stage('fuzzy index'):
+        return prepare_matcher(matcher)
+
+
+def reference_cache_dir(directory, use_cache=True):
+    return os.path.join(directory, CACHE_DIRNAME) if use_cache else None
+
+
+def load_reference(inputs, directory, use_cache=True, history=True, chunk_rows=None, vendor_dir=None,
+                   json_rows=False, export_dir=None, scenario_moves=None, pool=None):
+    """Load the inputs shared by every refresh: the watchlist and the broker stock codes.
+
+    With a pool both files are read concurrently and the fuzzy index is built up front.
+    scenario_moves (see scenario_moves()) adds the price scenario table to every report.
+    """
+    cache_dir = reference_cache_dir(directory, use_cache)
+    loaded = run_concurrently(pool, {
+        'watchlist': (inputs['collar'], load_watchlist, inputs['collar'], cache_dir),
+        'matcher': (inputs['stock_codes'], load_matcher if pool else load_stock_codes, inputs['stock_codes'],
+                    cache_dir),
+    })
+    return {
+        'cache_dir': cache_dir,
+        'chunk_rows': chunk_rows,
+        'vendor_dir': vendor_dir,
+        'json_rows': json_rows,
+        'export_dir': export_dir,
+        'scenario_moves': scenario_moves,
+        'history_dir': os.path.join(directory, HISTORY_DIRNAME) if history else None,
+        'date': inputs['date'],
+        'watchlist': loaded['watchlist'],
+        'matcher': loaded['matcher'],
     }
 
-    # ==== CE FILTER BLOCK ====
-    ce_all = df[df['Instrument'].str.contains('CE')].copy()
-    ce_all['stock'] = ce_all['Instrument'].apply(extract_stock)
-    ce_grouped = ce_all.groupby('stock').filter(lambda g: (g['Chg.'] != 0.000007).any())
 
-    pe_all = df[df['Instrument'].str.contains('PE')].copy()
-    pe_all['stock'] = pe_all['Instrument'].apply(extract_stock)
-    pe_grouped = pe_all.groupby('stock').filter(lambda g: (g['Chg.'] != 0.000007).any())
+# ==== REPORT ====
+def build_ce_filter(df):
+    """CE legs whose premium decay exceeds both the PE average and the CE-PE spread."""
+    legs = df[['stock', 'leg', 'Avg.', 'LTP', 'Chg.']]
+    # Stocks count once any of their legs has a real Chg. rather than the 0.000007 placeholder
+    ce_all = legs[legs['leg'] == 'CE']
+    ce_grouped = ce_all[(ce_all['Chg.'] != 0.000007).groupby(ce_all['stock'], observed=True).transform('any')]
+
+    pe_all = legs[legs['leg'] == 'PE']
+    pe_grouped = pe_all[(pe_all['Chg.'] != 0.000007).groupby(pe_all['stock'], observed=True).transform('any')]
 
     ce_merge = ce_grouped[['stock', 'Avg.', 'LTP', 'Chg.']].rename(columns={'Avg.': 'Avg_ce', 'LTP': 'LTP_ce', 'Chg.': 'Chg%'})
-    pe_avg = pe_grouped.groupby('stock')['Avg.'].mean().reset_index().rename(columns={'Avg.': 'PE_AVG'})
+    pe_avg = pe_grouped.groupby('stock', observed=True)['Avg.'].mean().reset_index().rename(columns={'Avg.': 'PE_AVG'})
 
     ce_merge = ce_merge.merge(pe_avg, on='stock', how='left')
     ce_merge['CE diff'] = ce_merge['Avg_ce'] - ce_merge['LTP_ce']
@@ -246,143 +1228,320 @@ def main():
     df_ce = ce_merge[(ce_merge['CE diff'] > ce_merge['PE_AVG']) & (ce_merge['CE diff'] > ce_merge['diff int'])]
     df_ce = df_ce[['stock', 'Avg_ce', 'LTP_ce', 'Chg%', 'PE_AVG', 'CE diff', 'diff int']]
     df_ce.columns = ['stockcode', 'Avg_ce', 'LTP_ce', 'Chg%', 'PE AVG', 'CE diff', 'diff int']
-    highlights = set(df_ce['stockcode'].str.upper().str.strip())
+    return df_ce.astype({'stockcode': str})
 
-    # ==== MOVEMENT BLOCK ====
-    move_records = []
-    for stock, grp in df.groupby('stock'):
-        fut = grp[grp['Instrument'].str.contains('FUT')]
-        if fut.empty:
-            continue
-        fut = fut.iloc[0]
-        stock_avg = fut['Avg.']
-        stock_ltp = fut['LTP']
-        stock_chg = fut['Chg.']
-        pe_list = grp[grp['Instrument'].str.contains('PE')]
-        pe_points = [float(m.group(1)) for inst in pe_list['Instrument'] if (m := re.search(r'(\d+(?:\.\d+)?)PE', inst))]
-        pe_point = np.mean(pe_points) if pe_points else 0
-        ce_list = grp[grp['Instrument'].str.contains('CE')]
-        ce_points = [float(m.group(1)) for inst in ce_list['Instrument'] if (m := re.search(r'(\d+(?:\.\d+)?)CE', inst))]
-        ce_point = np.mean(ce_points) if ce_points else 0
-        move_ce = (ce_point - stock_avg) / stock_avg * 100 if ce_point and stock_avg != 0 else 0
-        move_pe = (stock_avg - pe_point) / stock_avg * 100 if pe_point and stock_avg != 0 else 0
-        left_ce = (ce_point - stock_ltp) / stock_ltp * 100 if ce_point and stock_ltp != 0 else 0
-        left_pe = (stock_ltp - pe_point) / stock_ltp * 100 if pe_point and stock_ltp != 0 else 0
-
-        if not ce_all[ce_all['stock'] == stock].empty:
-            avg_ce = ce_all[ce_all['stock'] == stock]['Avg.'].mean()
-            ltp_ce = ce_all[ce_all['stock'] == stock]['LTP'].mean()
-        else:
-            avg_ce = 0
-            ltp_ce = 0
-        if not pe_all[pe_all['stock'] == stock].empty:
-            avg_pe = pe_all[pe_all['stock'] == stock]['Avg.'].mean()
-            ltp_pe = pe_all[pe_all['stock'] == stock]['LTP'].mean()
-        else:
-            avg_pe = 0
-            ltp_pe = 0
-        diff_int = avg_ce - avg_pe
-        ltp_ce1=0
-        ltp_pe1=0
-        if avg_ce > 0:
-            ltp_ce1=avg_ce - ltp_ce
-
-        if avg_pe > 0:
-            ltp_pe1 = ltp_pe - avg_pe
-
-        ltp_diff = ltp_ce1 + ltp_pe1
-
-
-
-        premium_pct = diff_int / stock_avg * 100 if stock_avg else 0
-        current_pct = ltp_diff / stock_avg * 100 if stock_avg else 0
-        left_ce_prem = left_ce + premium_pct if ce_point != 0 else 100
-        left_pe_prem = left_pe + premium_pct
-
-        diff =current_pct-premium_pct
-
-        if fut['Qty.'] != 0:
-            move_records.append({
-                'stockcode': stock,
-                'ce_point': ce_point,
-                'pe_point': pe_point,
-                'stock_chg_%': stock_chg,
-                'stock_avg': stock_avg,
-
-                'stock_ltp': stock_ltp,
-                'left ce (%)': left_ce,
-                'left pe (%)': left_pe,
-                'ltp ce' :ltp_ce,
-                'ltp pe' :ltp_pe,
-                'avg ce': avg_ce,
-                'avg_pe': avg_pe,
-                'current % ': current_pct,
-                'premium %': premium_pct,
-                'diff %': diff,
-                'left ce prem (%)': left_ce_prem,
-                'left pe prem (%)': left_pe_prem,
-                'move ce (%)': move_ce,
-                'move pe (%)': move_pe
-            })
-
-    df_move = pd.DataFrame(move_records)
-
-    # Debug stock lists
-    main_stocks = df_main['stockcode'].str.upper().str.strip().unique()
-    not_in_main = [stock for stock in watchlist_stocks if stock not in main_stocks]
-    not_in_watchlist = [stock for stock in main_stocks if stock not in watchlist_stocks]
-    print("Main stocks:", main_stocks)
-    print("Watchlist stocks:", watchlist_stocks)
-    print("Not in main:", not_in_main)
+
+# Columns that determine a stock's report rows; any change to them invalidates its cached rows.
+LEG_HASH_COLUMNS = ['Instrument', 'Qty.', 'Avg.', 'LTP', 'P&L', 'Chg.']
+
+
+def stock_hashes(df):
+    """Order-sensitive content hash of each stock's legs."""
+    import numpy as np
+    import pandas as pd
+
+    row_hash = pd.util.hash_pandas_object(df[LEG_HASH_COLUMNS], index=False).to_numpy()
+    position = df.groupby('stock').cumcount().to_numpy().astype(np.uint64)
+    return pd.Series(row_hash * (2 * position + 1), index=df['stock'].to_numpy()).groupby(level=0).sum()
+
+
+def build_stock_tables(df, cache=None):
+    """Per-stock MAIN REPORT rows (unsorted), CE filter and MOVEMENT BLOCK tables.
+
+    With a cache dict (kept by the caller between refreshes) only stocks whose legs
+    changed since the previous call are recomputed; rows of unchanged stocks are reused,
+    except for delta and theta, which move with the valuation time and are recomputed
+    for every stock.
+    """
+    import pandas as pd
+
+    if cache is None:
+        with stage('main report'):
+            rows = main_report_rows(df)
+        with stage('ce filter'):
+            df_ce = build_ce_filter(df)
+        with stage('movement block'):
+            df_move = build_movement(df)
+        return rows, df_ce, df_move
+
+    with stage('stock hashes'):
+        hashes = stock_hashes(df)
+    previous = cache.get('hashes')
+    if previous is None:
+        unchanged = []
+    else:
+        common = hashes.index.intersection(previous.index)
+        unchanged = common[hashes[common].to_numpy() == previous[common].to_numpy()]
+    changed = df[~df['stock'].isin(unchanged)]
+
+    def merge(name, fresh):
+        old = cache.get(name)
+        if old is None or len(unchanged) == 0:
+            return fresh
+        return pd.concat([old[old['stockcode'].isin(unchanged)], fresh], ignore_index=True)
+
+    with stage('main report'):
+        rows = merge('main', main_report_rows(changed))
+        rows = rows.sort_values('stockcode', kind='stable').reset_index(drop=True)
+    with stage('movement block'):
+        df_move = merge('move', build_movement(changed))
+        df_move = df_move.sort_values('stockcode', kind='stable').reset_index(drop=True)
+    with stage('greek totals'):
+        exposure = stock_exposure(df)
+        exposure.index = exposure.index.astype(str)
+        for frame in (rows, df_move):
+            current = exposure.reindex(frame['stockcode'])
+            frame['delta'] = current['net_delta'].to_numpy(dtype=float)
+            frame['theta'] = current['net_theta'].to_numpy(dtype=float)
+    with stage('ce filter'):
+        # CE rows follow the order of the CE legs in the positions file
+        df_ce = merge('ce', build_ce_filter(changed))
+        first_leg = df[df['leg'] == 'CE'].drop_duplicates('stock').reset_index(drop=True)
+        order = pd.Series(first_leg.index, index=first_leg['stock'])
+        df_ce = df_ce.iloc[df_ce['stockcode'].map(order).argsort(kind='stable')].reset_index(drop=True)
+
+    note(recomputed=changed['stock'].nunique(), stocks=len(hashes))
+    cache.update({'hashes': hashes, 'main': rows, 'ce': df_ce, 'move': df_move})
+    return rows, df_ce, df_move
+
+
+def build_tables(df, reference, cache=None):
+    """Compute every report table from parsed positions and the loaded reference data.
+
+    cache is an optional dict reused across refreshes to skip stocks whose legs are unchanged.
+    """
+    import pandas as pd
+
+    watchlist_df = reference['watchlist']['df']
+    watchlist_stocks = reference['watchlist']['stocks']
+    high_value_stocks = reference['watchlist']['high_value']
+
+    with stage('option pricing'):
+        df = df.join(option_greeks(df, valuation_time(reference['date'])))
+
+    # ==== MAIN REPORT, CE FILTER BLOCK and MOVEMENT BLOCK ====
+    main_rows, df_ce, df_move = build_stock_tables(df, cache)
+    df_main, footer = finish_main_report(main_rows)
+    # Stock codes parsed from instrument names are already upper-case and stripped
+    highlights = set(df_ce['stockcode'])
+
+    num_records = len(df_move)
+    move_footer = {c: '' for c in df_move.columns}
+    move_footer.update({
+        'stockcode': 'TOTAL',
+        'stock_chg_%': df_move['stock_chg_%'].sum() / num_records if num_records > 0 else 0.0,
+        'current % ': df_move['current % '].sum(),
+        'premium %': df_move['premium %'].sum(),
+        'delta': df_move['delta'].sum(),
+        'theta': df_move['theta'].sum(),
+    })
+
+    main_stocks = df_main['stockcode'].unique()
+    main_set, watchlist_set = set(main_stocks), set(watchlist_stocks)
+    not_in_main = [stock for stock in watchlist_stocks if stock not in main_set]
+    not_in_watchlist = [stock for stock in main_stocks if stock not in watchlist_set]
 
     # ==== WATCHLIST STOCKS NOT IN POSITIONS ====
+    not_in_main_rows = reference['watchlist']['codes'].isin(not_in_main)
     try:
-        columns_to_select = ['NSE Code', 'LTP', 'Change (%)', 'TL Durability Score', 'TL Valuation Score', 'TL Momentum Score', 'Stock Classification']
-        available_columns = [col for col in columns_to_select if col in watchlist_df.columns]
-        not_in_main_df = watchlist_df[watchlist_df['NSE Code'].str.upper().str.strip().isin(not_in_main)][available_columns].copy()
-        not_in_main_df.rename(columns={'NSE Code': 'stockcode', 'LTP': 'current_price', 'Change (%)': 'change_%'}, inplace=True)
+        available_columns = [col for col in WATCHLIST_COLUMNS if col in watchlist_df.columns]
+        not_in_main_df = watchlist_df.loc[not_in_main_rows, available_columns].rename(
+            columns={'NSE Code': 'stockcode', 'LTP': 'current_price', 'Change (%)': 'change_%'})
     except KeyError as e:
         print(f"Error: Column not found in watchlist. {e}. Available columns:", watchlist_df.columns)
         not_in_main_df = pd.DataFrame(columns=['stockcode', 'current_price', 'change_%', 'TL Durability Score', 'TL Valuation Score', 'TL Momentum Score', 'Stock Classification'])
 
     # ==== POSITIONS NOT IN WATCHLIST ====
-    not_in_watchlist_df = df_main[df_main['stockcode'].str.upper().str.strip().isin(not_in_watchlist)]
+    not_in_watchlist_df = df_main[df_main['stockcode'].isin(not_in_watchlist)]
+
+    # Match every reported stock against the broker's stock codes
+    all_stockcodes = set(main_stocks) | highlights | set(df_move['stockcode'])
+    if 'stockcode' in not_in_main_df.columns:
+        all_stockcodes.update(reference['watchlist']['codes'][not_in_main_rows])
+    with stage('fuzzy matching'):
+        matches = resolve_matches(all_stockcodes, reference['matcher'])
+    matched_stockcodes = {stockcode for stockcode, match in matches.items() if match}
+    note(main_stocks=len(df_main), not_in_watchlist=len(not_in_watchlist_df), ce_rows=len(df_ce),
+         move_rows=len(df_move), watchlist_not_positions=len(not_in_main_df), matched=len(matched_stockcodes))
+
+    tables = {
+        'main': df_main,
+        'footer': footer,
+        'not_in_watchlist': not_in_watchlist_df,
+        'ce': df_ce,
+        'move': df_move,
+        'move_footer': move_footer,
+        'watchlist_not_positions': not_in_main_df,
+        'context': {
+            'highlights': list(highlights),
+            'high_value': list(high_value_stocks),
+            'not_in_watchlist': list(not_in_watchlist),
+            'matched': list(matched_stockcodes),
+        },
+    }
+    if reference['scenario_moves'] is not None:
+        with stage('scenarios'):
+            tables['scenarios'], tables['scenario_footer'] = build_scenarios(df, reference['scenario_moves'])
+    note_frames(positions=df, watchlist=watchlist_df, **{name: tables[name] for name in TABLE_RULES if name in tables})
+    return tables
+
 
-    # Read stock_codes.csv and compute matched_stockcodes
+# ==== SNAPSHOT HISTORY ====
+# Every run appends its tables to <dir>/history/<table>/<YYYY-MM-DD>/<run>.arrow. Files are
+# never rewritten, and are stored uncompressed so range queries can memory-map them.
+SNAPSHOT_TABLES = ['main', 'move']
+
+
+def append_snapshot(history_dir, tables, date, account=''):
+    """Store this run's MAIN REPORT and movement tables under the report date."""
     try:
-        stock_codes_df = pd.read_csv(r"C:\Users\rohit\Documents\stocks\stock_codes.csv")
-        m_stock_codes = stock_codes_df['m_stock_code'].str.upper().str.strip().unique().tolist()
+        import pyarrow as pa
+        import pyarrow.feather as feather
+    except ImportError:
+        return
+    run_at = datetime.datetime.now()
+    name = f"{run_at:%H%M%S%f}-{os.getpid()}.arrow"
+    for table in SNAPSHOT_TABLES:
+        frame = tables[table]
+        snapshot = pa.Table.from_pandas(frame, preserve_index=False)
+        snapshot = snapshot.append_column('date', pa.array([date] * len(frame), pa.date32()))
+        snapshot = snapshot.append_column('run_at', pa.array([run_at] * len(frame), pa.timestamp('us')))
+        snapshot = snapshot.append_column('account', pa.array([account] * len(frame), pa.string()))
+        path = os.path.join(history_dir, table, date.isoformat(), name)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f'{path}.tmp'
+            feather.write_feather(snapshot, tmp, compression='uncompressed')
+            os.replace(tmp, path)
+        except (OSError, ValueError) as e:
+            print(f"Error storing {table} snapshot: {e}")
+
+
+def read_history(history_dir, table, start=None, end=None, stocks=None, columns=None, where=None,
+                 all_runs=False):
+    """Stored rows of one snapshot table for report dates in [start, end].
+
+    Only the date partitions in range are opened, and only the requested columns are
+    read from them. Older snapshots lacking a column (e.g. one added since) read it as
+    null. By default each date contributes its last run (per account).
+    `where` is a DataFrame.query() expression, e.g. "`left ce (%)` < 0.5".
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.feather as feather
+
+    root = os.path.join(history_dir, table)
+    try:
+        days = sorted(os.listdir(root))
     except FileNotFoundError:
-        print("Error: stock_codes.csv not found.")
-        m_stock_codes = []
-    except KeyError:
-        print("Error: 'm_stock_code' column not found in stock_codes.csv.")
-        m_stock_codes = []
+        days = []
+    days = [d for d in days if (start is None or d >= start.isoformat()) and (end is None or d <= end.isoformat())]
+
+    keys = ['date', 'run_at', 'account', 'stockcode']
+    read_columns = None if columns is None else keys + [c for c in columns if c not in keys]
+    parts = []
+    for day in days:
+        runs = sorted(f for f in os.listdir(os.path.join(root, day)) if f.endswith('.arrow'))
+        seen = set()
+        # Newest first: a later run of the day supersedes earlier ones for the accounts it covers
+        for run in reversed(runs):
+            path = os.path.join(root, day, run)
+            present = None
+            if read_columns is not None:
+                with pa.memory_map(path) as source:
+                    names = set(pa.ipc.open_file(source).schema.names)
+                present = [c for c in read_columns if c in names]
+            part = feather.read_table(path, columns=present, memory_map=True)
+            if not all_runs:
+                accounts = set(part.column('account').unique().to_pylist())
+                if seen:
+                    part = part.filter(pc.invert(pc.is_in(part.column('account'), value_set=pa.array(list(seen)))))
+                seen |= accounts
+            if stocks is not None:
+                part = part.filter(pc.is_in(part.column('stockcode'), value_set=pa.array(list(stocks))))
+            parts.append(part)
+    parts = [p for p in parts if p.num_rows]
+    if not parts:
+        import pandas as pd
+        return pd.DataFrame(columns=read_columns or keys)
+    df = pa.concat_tables(parts, promote_options='default').to_pandas(strings_to_categorical=True)
+    df = df.sort_values(['date', 'run_at'], kind='stable')
+    df = df[keys + [c for c in df.columns if c not in keys]]
+    for column in read_columns or []:
+        if column not in df.columns:
+            df[column] = None
+    if where:
+        df = df.query(where)
+    return df.reset_index(drop=True)
+
+
+# ==== TABLE EXPORT ====
+def json_value(value):
+    """A table or footer value as plain JSON: numpy scalars unwrapped, NaN as null."""
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def table_document(tables, name):
+    """One table as JSON-ready data: columns, rows, the rows each highlight rule matched, footer."""
+    frame = tables[name].reset_index(drop=True)
+    masks = highlight_masks(frame, TABLE_RULES[name], tables['context'])
+    footer = tables[TABLE_FOOTERS[name]] if name in TABLE_FOOTERS else {}
+    return {
+        'columns': list(frame.columns),
+        'rows': [[json_value(v) for v in row] for row in frame.itertuples(index=False)],
+        'highlights': {rule: mask.nonzero()[0].tolist() for rule, mask in masks.items()},
+        'footer': {c: json_value(v) for c, v in footer.items()},
+    }
 
-    all_stockcodes = set()
-    for df in [df_main, df_ce, df_move]:
-        if 'stockcode' in df.columns:
-            all_stockcodes.update(df['stockcode'].str.upper().str.strip())
-    if 'stockcode' in not_in_main_df.columns:
-        all_stockcodes.update(not_in_main_df['stockcode'].str.upper().str.strip())
-    if 'stockcode' in not_in_watchlist_df.columns:
-        all_stockcodes.update(not_in_watchlist_df['stockcode'].str.upper().str.strip())
-
-    matched_stockcodes = set()
-    for stockcode in all_stockcodes:
-        matches = difflib.get_close_matches(stockcode, m_stock_codes, n=1, cutoff=0.9)
-        if matches:
-            matched_stockcodes.add(stockcode)
-    print("active broker report")
-    print(matched_stockcodes)
 
-    # ==== HTML OUTPUT ====
-    html = []
-    html.append("""
-    <html>
-    <head>
-        <title>Financial Report</title>
-        <style>
+def export_tables(tables, export_dir, date=None):
+    """Write every report table, with one boolean hl_<rule> column per highlight rule.
+
+    Each table goes to <name>.arrow (uncompressed Arrow IPC, so readers can memory-map it
+    without copying; footers are in the schema metadata), and all of them to one
+    compact tables.json. Without pyarrow only the JSON is written.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.feather as feather
+    except ImportError:
+        feather = None
+    os.makedirs(export_dir, exist_ok=True)
+    document = {'date': date.isoformat() if date else None, 'tables': {}}
+    for name in TABLE_RULES:
+        if name not in tables:
+            continue
+        table_json = document['tables'][name] = table_document(tables, name)
+        if feather is None:
+            continue
+        frame = tables[name].reset_index(drop=True)
+        flagged = frame.assign(**{f'hl_{rule}': frame.index.isin(rows)
+                                  for rule, rows in table_json['highlights'].items()})
+        table = pa.Table.from_pandas(flagged, preserve_index=False)
+        footer = json.dumps(table_json['footer'])
+        table = table.replace_schema_metadata(dict(table.schema.metadata or {}, footer=footer))
+        path = os.path.join(export_dir, f'{name}.arrow')
+        try:
+            feather.write_feather(table, f'{path}.tmp', compression='uncompressed')
+            os.replace(f'{path}.tmp', path)
+        except (OSError, ValueError) as e:
+            print(f"Error exporting {name}: {e}")
+
+    path = os.path.join(export_dir, 'tables.json')
+    try:
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(document, f, separators=(',', ':'), allow_nan=False)
+        os.replace(f'{path}.tmp', path)
+    except (OSError, ValueError) as e:
+        print(f"Error exporting {path}: {e}")
+
+
+# ==== HTML PAGE ====
+REPORT_CSS = """
             body {
                 font-family: 'Times New Roman', Times, serif;
                 background-color: #f9f9f9;
@@ -398,7 +1557,7 @@ def main():
                 padding: 1rem;
                 text-align: left;
                 border: 1px solid #cccccc;
-                font-size: 1.1rem;
+                font-size: 14px;
             }
             th {
                 background-color: #E1F5FE;
@@ -428,8 +1587,9 @@ def main():
             .table-controls {
                 display: flex;
                 align-items: center;
-                gap: 1rem;
-                margin-bottom: 1rem;
+                gap: 0.3rem;
+                margin-bottom: 0.3rem;
+                margin-top: 0; /* Ensure no extra space above controls */
             }
             .filter-btn, .color-filter, .dt-buttons button {
                 margin: 0;
@@ -461,11 +1621,13 @@ def main():
             .dt-buttons {
                 margin: 0;
             }
-            
             .table-section {
-                margin-bottom: 4rem;
+                margin-bottom: 0.5rem;
                 overflow-x: auto;
             }
+            .table-section h2 {
+                margin-bottom: 0.1rem; /* Further reduced space between heading and table block */
+            }
             .filter-row th {
                 padding: 0.5rem;
             }
@@ -494,56 +1656,54 @@ def main():
                 color: #999;
                 margin-right: 5px;
             }
-            .table-section h2 {
-            margin-bottom: 0.1rem; /* Further reduced space between heading and table block */
-        }
-         th, td {
-            padding: 1rem;
-            text-align: left;
-            border: 1px solid #cccccc;
-            font-size: 14px;
-        }
-        .table-controls {
-            display: flex;
-            align-items: center;
-            gap: 0.3rem;
-            margin-bottom: 0.3rem;
-            margin-top: 0; /* Ensure no extra space above controls */
-        }
-        .table-section {
-        margin-bottom: 0.5rem;
-        overflow-x: auto;
-        }
-        </style>
-        <link rel="stylesheet" type="text/css" href="https://cdn.datatables.net/1.11.5/css/jquery.dataTables.min.css">
-        <link href="https://cdn.jsdelivr.net/npm/select2@4.1.0-rc.0/dist/css/select2.min.css" rel="stylesheet" />
-        <script src="https://code.jquery.com/jquery-3.6.0.min.js"></script>
-        <script src="https://cdn.datatables.net/1.11.5/js/jquery.dataTables.min.js"></script>
-        <script src="https://cdn.datatables.net/buttons/2.2.2/js/dataTables.buttons.min.js"></script>
-        <script src="https://cdn.datatables.net/buttons/2.2.2/js/buttons.html5.min.js"></script>
-        <script src="https://cdn.jsdelivr.net/npm/select2@4.1.0-rc.0/dist/js/select2.min.js"></script>
-        <script>
+"""
+# Stylesheets and scripts the report loads, in order. Offline reports inline the file of the
+# same name from the vendor directory instead.
+REPORT_ASSETS = [
+    'https://cdn.datatables.net/1.11.5/css/jquery.dataTables.min.css',
+    'https://cdn.jsdelivr.net/npm/select2@4.1.0-rc.0/dist/css/select2.min.css',
+    'https://code.jquery.com/jquery-3.6.0.min.js',
+    'https://cdn.datatables.net/1.11.5/js/jquery.dataTables.min.js',
+    'https://cdn.datatables.net/buttons/2.2.2/js/dataTables.buttons.min.js',
+    'https://cdn.datatables.net/buttons/2.2.2/js/buttons.html5.min.js',
+    'https://cdn.jsdelivr.net/npm/select2@4.1.0-rc.0/dist/js/select2.min.js',
+]
+REPORT_SCRIPT = """
+            // Verbose logging is off unless the report is opened with ?debug (or #debug) in the URL
+            var DEBUG = /[?&#]debug\\b/.test(window.location.search + window.location.hash);
+            function debug() {
+                if (DEBUG) console.log.apply(console, arguments);
+            }
+
             $(document).ready(function() {
-                console.log('Document ready - Starting DataTables initialization');
+                debug('Document ready - Starting DataTables initialization');
                 if (typeof jQuery === 'undefined') {
-                    console.error('jQuery not loaded. Ensure an internet connection for CDN links.');
+                    console.error('jQuery not loaded. Check the network, or build the report with --offline.');
                     return;
                 }
                 if (typeof $.fn.DataTable === 'undefined') {
-                    console.error('DataTables not loaded. Ensure an internet connection for CDN links.');
+                    console.error('DataTables not loaded. Check the network, or build the report with --offline.');
                     return;
                 }
                 if (typeof $.fn.select2 === 'undefined') {
-                    console.error('Select2 not loaded. Ensure an internet connection for CDN links.');
+                    console.error('Select2 not loaded. Check the network, or build the report with --offline.');
                     return;
                 }
-                console.log('jQuery, DataTables, and Select2 loaded successfully');
+                debug('jQuery, DataTables, and Select2 loaded successfully');
 
                 var tables = [];
+                var FILTER_CLASSES = ['highlight_cell_main', 'highlight_cell_move', 'high_value', 'not_in_watchlist',
+                                      'net_highlight', 'collar_credit', 'recent_match'];
                 $('.table-section').each(function() {
                     var section = $(this);
                     var tableId = section.find('table').attr('id');
-                    console.log('Initializing table #' + tableId);
+                    debug('Initializing table #' + tableId);
+
+                    // Tables rendered with json_rows carry their rows and highlight flags as JSON
+                    var dataScript = section.find('script.table-data');
+                    var tableData = dataScript.length ? JSON.parse(dataScript.text()) : null;
+                    // Per-column filter metadata from render_table(): distinct strings, numeric min/max
+                    var filters = JSON.parse(section.find('script.table-filters').text());
 
                     // Add filter row to thead
                     var thead = section.find('thead');
@@ -564,30 +1724,47 @@ def main():
                             orderCellsTop: true,
                             orderMulti: true, // Enable multi-column sorting
                             pageLength: 10,
+                            data: tableData ? tableData.rows : undefined,
+                            deferRender: !!tableData,
+                            createdRow: tableData ? function(row, rowData, dataIndex) {
+                                var f = tableData.flags[dataIndex];
+                                tableData.legend.forEach(function(entry, bit) {
+                                    if (f & (1 << bit)) (entry[0] < 0 ? row : row.cells[entry[0]]).classList.add(entry[1]);
+                                });
+                            } : undefined,
                             initComplete: function() {
-                                console.log('initComplete for table: ' + tableId);
+                                debug('initComplete for table: ' + tableId);
                                 var api = this.api();
+                                var ranges = [];  // active numeric bounds: {col, min, max}
+                                var numbers = {};  // column index -> Float64Array of the cell values, by row index
+
+                                function updateRanges() {
+                                    ranges = [];
+                                    filters.columns.forEach(function(meta, colIndex) {
+                                        if (meta.type !== 'numeric') return;
+                                        var min = parseFloat(meta.minInput.val());
+                                        var max = parseFloat(meta.maxInput.val());
+                                        if (isNaN(min) && isNaN(max)) return;
+                                        ranges.push({col: colIndex, min: isNaN(min) ? -Infinity : min, max: isNaN(max) ? Infinity : max});
+                                    });
+                                    debug('Numeric ranges for table ' + tableId + ':', ranges);
+                                    api.draw();
+                                }
+
                                 api.columns().every(function() {
                                     var column = this;
-                                    var header = $(column.header());
-                                    var colType = header.data('type');
                                     var colIndex = column.index();
+                                    var meta = filters.columns[colIndex];
                                     var filterCell = filterRow.find('th').eq(colIndex);
 
-                                    console.log('Processing column ' + colIndex + ' in table ' + tableId + ', type: ' + colType);
-                                    if (colType === 'string') {
-                                        console.log('Adding Select2 multiple-select dropdown filter for column ' + colIndex);
+                                    if (meta.type === 'string') {
                                         var select = $('<select multiple></select>').appendTo(filterCell);
+                                        select.append(meta.values.map(function(value) {
+                                            return $('<option></option>').attr('value', value).text(value);
+                                        }));
 
-                                        console.log('Populating dropdown options for column ' + colIndex + ': ' + column.data().unique().sort().join(', '));
-                                        column.data().unique().sort().each(function(d, j) {
-                                            var optionText = String(d).trim();
-                                            if (optionText !== '') {
-                                                select.append('<option value="' + optionText + '">' + optionText + '</option>');
-                                            }
-                                        });
-
-                                        select.select2({                                           placeholder: 'Search options...',
+                                        select.select2({
+                                            placeholder: 'Search options...',
                                             allowClear: true,
                                             width: '100px',
                                             minimumInputLength: 0
@@ -595,100 +1772,86 @@ def main():
 
                                         select.on('change', function() {
                                             var selectedVals = $(this).val() ? $(this).val().map(val => $.fn.dataTable.util.escapeRegex(val)) : [];
-                                            console.log('Dropdown filter changed for column ' + colIndex + ': Values="' + selectedVals.join(', ') + '"');
+                                            debug('Dropdown filter changed for column ' + colIndex + ': ' + selectedVals.join(', '));
                                             try {
                                                 var regex = selectedVals.length ? '^(?:' + selectedVals.join('|') + ')$' : '';
                                                 column.search(regex, true, false).draw();
-                                                console.log('Column filter applied successfully for column ' + colIndex);
                                             } catch (e) {
                                                 console.error('Error applying column filter for column ' + colIndex, e);
                                             }
                                         })
                                         .on('click', function(e) {
                                             e.stopPropagation();
-                                            console.log('Click on dropdown for column ' + colIndex + ' stopped propagation');
                                         });
-                                    } else if (colType === 'numeric') {
-                                        console.log('Adding range filter for column ' + colIndex);
-                                        var minInput = $('<input type="number" placeholder="Min" style="width:80px;" />')
-                                            .appendTo(filterCell)
-                                            .on('input', function() {
-                                                console.log('Numeric filter (Min) changed for column ' + colIndex + ': ' + $(this).val());
-                                                try {
-                                                    api.draw();
-                                                    console.log('Numeric filter applied successfully for column ' + colIndex);
-                                                } catch (e) {
-                                                    console.error('Error applying numeric filter for column ' + colIndex, e);
-                                                }
-                                            })
-                                            .on('click', function(e) {
-                                                e.stopPropagation();
-                                                console.log('Click on Min input for column ' + colIndex + ' stopped propagation');
-                                            });
-
-                                        var maxInput = $('<input type="number" placeholder="Max" style="width:80px;" />')
-                                            .appendTo(filterCell)
+                                    } else if (meta.type === 'numeric') {
+                                        // Parsed once; "nan" and other non-numbers compare as 0, as they always have
+                                        numbers[colIndex] = Float64Array.from(api.column(colIndex, {order: 'index'}).data().toArray(),
+                                                                              function(v) { return parseFloat(v) || 0; });
+                                        meta.minInput = $('<input type="number" style="width:80px;" />')
+                                            .attr({placeholder: meta.min === null ? 'Min' : 'Min ' + meta.min, step: 'any'})
+                                            .appendTo(filterCell);
+                                        meta.maxInput = $('<input type="number" style="width:80px;" />')
+                                            .attr({placeholder: meta.max === null ? 'Max' : 'Max ' + meta.max, step: 'any'})
+                                            .appendTo(filterCell);
+                                        meta.minInput.add(meta.maxInput)
                                             .on('input', function() {
-                                                console.log('Numeric filter (Max) changed for column ' + colIndex + ': ' + $(this).val());
                                                 try {
-                                                    api.draw();
-                                                    console.log('Numeric filter applied successfully for column ' + colIndex);
+                                                    updateRanges();
                                                 } catch (e) {
                                                     console.error('Error applying numeric filter for column ' + colIndex, e);
                                                 }
                                             })
                                             .on('click', function(e) {
                                                 e.stopPropagation();
-                                                console.log('Click on Max input for column ' + colIndex + ' stopped propagation');
                                             });
-
-                                        header.data('minInput', minInput);
-                                        header.data('maxInput', maxInput);
                                     }
                                 });
 
-                                // Custom search for numeric range
-                                console.log('Setting up custom search function for numeric range filtering');
+                                // Numeric range filter: only the active bounds are checked, against the typed arrays
                                 $.fn.dataTable.ext.search.push(
                                     function(settings, data, dataIndex) {
-                                        if (settings.nTable !== api.table().node()) {
-                                            console.log('Custom search: Skipping table as it does not match current table');
-                                            return true;
-                                        }
-                                        var columns = api.columns().nodes().length;
-                                        for (var colIndex = 0; colIndex < columns; colIndex++) {
-                                            var column = api.column(colIndex);
-                                            var header = $(column.header());
-                                            if (header.data('type') === 'numeric') {
-                                                var minVal = parseFloat(header.data('minInput').val()) || -Infinity;
-                                                var maxVal = parseFloat(header.data('maxInput').val()) || Infinity;
-                                                var cellValue = parseFloat(data[colIndex]) || 0;
-                                                if (cellValue < minVal || cellValue > maxVal) {
-                                                    console.log('Row filtered out for column ' + colIndex + ': value=' + cellValue + ', min=' + minVal + ', max=' + maxVal);
-                                                    return false;
-                                                }
-                                            }
+                                        if (settings.nTable !== api.table().node()) return true;
+                                        for (var i = 0; i < ranges.length; i++) {
+                                            var value = numbers[ranges[i].col][dataIndex];
+                                            if (value < ranges[i].min || value > ranges[i].max) return false;
                                         }
                                         return true;
                                     }
                                 );
-                                console.log('Custom search function for numeric range filtering set up successfully');
                             }
                         });
 
-                        // Dynamically determine which highlight classes are present in the table
-                             // Dynamically determine which highlight classes are present in the table
-                var highlightClasses = new Set();
-                table.rows().every(function() {
-                    var row = $(this.node());
-                    if (row.find('.highlight_cell_main').length > 0) highlightClasses.add('highlight_cell_main');
-                    if (row.find('.highlight_cell_move').length > 0) highlightClasses.add('highlight_cell_move');
-                    if (row.find('.high_value').length > 0) highlightClasses.add('high_value');
-                    if (row.find('.not_in_watchlist').length > 0) highlightClasses.add('not_in_watchlist');
-                    if (row.find('.net_highlight').length > 0) highlightClasses.add('net_highlight');
-                    if (row.find('.collar_credit').length > 0) highlightClasses.add('collar_credit');
-                    if (row.find('.recent_match').length > 0) highlightClasses.add('recent_match');
-                });
+                // Per-row highlight flags: bit i of flags[row] is set when legend[i] = [column, class] applies.
+                // DOM tables are scanned once here; JSON tables ship their flags.
+                var legend = tableData ? tableData.legend : [];
+                var flags = tableData ? tableData.flags : [];
+                if (!tableData) {
+                    table.rows().every(function(rowIdx) {
+                        var f = 0;
+                        $(this.node()).children('td').each(function(col) {
+                            for (var k = 0; k < this.classList.length; k++) {
+                                var css = this.classList[k];
+                                if (FILTER_CLASSES.indexOf(css) < 0) continue;
+                                var bit = legend.findIndex(function(entry) { return entry[0] === col && entry[1] === css; });
+                                if (bit < 0) {
+                                    bit = legend.length;
+                                    legend.push([col, css]);
+                                }
+                                f |= 1 << bit;
+                            }
+                        });
+                        flags[rowIdx] = f;
+                    });
+                }
+                function classMask(classes) {
+                    var mask = 0;
+                    legend.forEach(function(entry, bit) {
+                        if (entry[0] >= 0 && classes.indexOf(entry[1]) >= 0) mask |= 1 << bit;
+                    });
+                    return mask;
+                }
+                var present = flags.reduce(function(all, f) { return all | f; }, 0);
+                var highlightClasses = new Set(FILTER_CLASSES.filter(function(css) { return present & classMask([css]); }));
 
                 // Create color filter dropdown based on present classes with better names
                 var dropdownOptions = '<option value="all">Show All Rows</option>';
@@ -709,28 +1872,25 @@ def main():
                 section.find('.dt-buttons').detach().appendTo(controls);
 
                 // Add custom filter for DataTables
+                var colorMask = null;
                 $.fn.dataTable.ext.search.push(
                     function(settings, data, dataIndex) {
-                        var selectedClass = section.find('.color-filter').val();
-                        if (selectedClass === 'all') return true;
-                        if (selectedClass === 'highlighted') {
-                            var row = table.row(dataIndex).node();
-                            return $(row).find('.highlight_cell_main, .highlight_cell_move, .high_value, .not_in_watchlist, .net_highlight, .collar_credit, .recent_match').length > 0;
-                        }
-                        var row = table.row(dataIndex).node();
-                        return $(row).find('.' + selectedClass).length > 0;
+                        if (settings.nTable !== table.table().node() || colorMask === null) return true;
+                        return (flags[dataIndex] & colorMask) !== 0;
                     }
                 );
 
                 section.find('.color-filter').change(function() {
                     var selectedClass = $(this).val();
-                    console.log("Color filter changed to", selectedClass);
+                    colorMask = selectedClass === 'all' ? null
+                        : classMask(selectedClass === 'highlighted' ? FILTER_CLASSES : [selectedClass]);
+                    debug("Color filter changed to", selectedClass);
                     table.draw(); // Apply the custom filter
                     table.page(0).draw('page'); // Go to the first page
                 });
 
                 section.find('.filter-btn').click(function() {
-                    console.log("Filter button clicked, current text:", $(this).text());
+                    debug("Filter button clicked, current text:", $(this).text());
                     if ($(this).text() === 'Show Highlighted Rows Only') {
                         section.find('.color-filter').val('highlighted').trigger('change');
                         $(this).text('Show All Rows');
@@ -740,16 +1900,17 @@ def main():
                     }
                 });
                         // Log sorting events
-                        console.log('Setting up sorting event listener for table: ' + tableId);
-                        section.find('thead tr:first th').on('click.DT', function() {
-                            var order = table.order();
-                            var sortDetails = order.map(function(orderItem) {
-                                return 'Column ' + orderItem[0] + ' (' + api.column(orderItem[0]).header().textContent + '): ' + orderItem[1];
-                            }).join(', ');
-                            console.log('Sorting triggered: ' + (sortDetails || 'No sorting applied'));
-                        });
+                        if (DEBUG) {
+                            section.find('thead tr:first th').on('click.DT', function() {
+                                var order = table.order();
+                                var sortDetails = order.map(function(orderItem) {
+                                    return 'Column ' + orderItem[0] + ' (' + table.column(orderItem[0]).header().textContent + '): ' + orderItem[1];
+                                }).join(', ');
+                                debug('Sorting triggered: ' + (sortDetails || 'No sorting applied'));
+                            });
+                        }
 
-                        console.log('DataTables initialized successfully for table: ' + tableId);
+                        debug('DataTables initialized successfully for table: ' + tableId);
                         tables.push(table);
                     } catch (e) {
                         console.error('Error initializing DataTables for table: ' + tableId, e);
@@ -757,203 +1918,712 @@ def main():
                 });
 
                 // Global filter across all tables
-                console.log('Setting up global filter');
+                debug('Setting up global filter');
                 $('#global_filter').on('input', function() {
                     var value = $.fn.dataTable.util.escapeRegex($(this).val());
-                    console.log('Global filter applied across all tables: "' + value + '"');
+                    debug('Global filter applied across all tables: "' + value + '"');
                     tables.forEach(function(table, index) {
-                        console.log('Applying global filter to table #' + (index + 1));
+                        debug('Applying global filter to table #' + (index + 1));
                         try {
                             table.search(value).draw();
-                            console.log('Global filter applied successfully to table #' + (index + 1));
+                            debug('Global filter applied successfully to table #' + (index + 1));
                         } catch (e) {
                             console.error('Error applying global filter to table #' + (index + 1), e);
                         }
                     });
                 });
 
-                console.log('DataTables initialization complete');
+                debug('DataTables initialization complete');
             });
             
-        </script>
-    </head>
+"""
+REPORT_BODY = """
     <body>
         <h1>Financial Report</h1>
         <input type="text" id="global_filter" placeholder="Search all tables...">
         <p style="font-size: 12px; color: #555;">Hold Shift and click column headers to sort by multiple columns.</p>
-        """)
+        """
+
+
+def minify_css(css):
+    """Strip comments and redundant whitespace from a stylesheet."""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    return re.sub(r':\s+', ':', css).replace(';}', '}').strip()
+
+
+def minify_js(js):
+    """Drop indentation and blank lines; already-minified vendor scripts pass through unchanged."""
+    return '\n'.join(line.strip() for line in js.splitlines() if line.strip())
+
+
+def inline_css_urls(css, base_dir):
+    """Embed the images a stylesheet references as data: URIs, when they exist under base_dir."""
+    import base64
+    import mimetypes
+
+    def embed(match):
+        ref = match.group(2)
+        path = os.path.join(base_dir, os.path.basename(ref.split('?')[0].split('#')[0]))
+        if ref.startswith('data:') or not os.path.isfile(path):
+            return match.group(0)
+        mime = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        with open(path, 'rb') as f:
+            return f"url(data:{mime};base64,{base64.b64encode(f.read()).decode('ascii')})"
+
+    return re.sub(r"""url\((['"]?)([^'")]+)\1\)""", embed, css)
+
+
+@functools.lru_cache(maxsize=None)
+def report_head(vendor_dir=None):
+    """The report's <head> and page header.
+
+    With vendor_dir, every REPORT_ASSETS file is read from that folder and inlined (along
+    with the images its stylesheet uses) so the page needs no network access; styles and
+    the report script are minified.
+    """
+    if vendor_dir is None:
+        links = [f'<link rel="stylesheet" type="text/css" href="{url}">' if url.endswith('.css')
+                 else f'<script src="{url}"></script>' for url in REPORT_ASSETS]
+        return ('<html>\n<head>\n<title>Financial Report</title>\n<style>' + REPORT_CSS + '</style>\n'
+                + '\n'.join(links) + '\n<script>' + REPORT_SCRIPT + '</script>\n</head>\n' + REPORT_BODY)
+
+    styles, scripts = [minify_css(REPORT_CSS)], []
+    for url in REPORT_ASSETS:
+        name = os.path.basename(url)
+        path = os.path.join(vendor_dir, name)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"{name} not found in vendor directory {vendor_dir} (download it from {url}).")
+        with open(path, encoding='utf-8') as f:
+            asset = f.read()
+        if name.endswith('.css'):
+            styles.append(minify_css(inline_css_urls(asset, vendor_dir)))
+        else:
+            scripts.append(asset if name.endswith('.min.js') else minify_js(asset))
+    scripts.append(minify_js(REPORT_SCRIPT))
+    # A literal "</script" inside a script would end the inline block early
+    scripts = [js.replace('</script', '<\\/script') for js in scripts]
+    return ('<html><head><title>Financial Report</title><style>' + ''.join(styles) + '</style>'
+            + ''.join(f'<script>{js}</script>' for js in scripts) + '</head>' + REPORT_BODY)
+
+
+def render_page(sections, vendor_dir=None):
+    """Wrap rendered table sections in the report page (styles, DataTables scripts, global filter)."""
+    return report_head(vendor_dir) + ''.join(sections) + '</body></html>'
+
+
+def render_report(tables, vendor_dir=None, json_rows=False):
+    """Render the computed tables as the full HTML report page."""
+    df_main = tables['main']
+    df_ce = tables['ce']
+    df_move = tables['move']
+    not_in_watchlist_df = tables['not_in_watchlist']
+    not_in_main_df = tables['watchlist_not_positions']
+    highlight_context = tables['context']
+
+    # ==== HTML OUTPUT ====
+    html = []
+
+    main_cols = {c: 'string' if c == 'stockcode' else 'numeric' for c in df_main.columns}
 
-    # Add data-type attributes to tables for filtering
     # Main Table with Cell Highlighting
-    html.append('<div class="table-section"><h2>Main Positions</h2><table id="main_positions">')
-    html.append('<thead><tr>' + ''.join(f'<th data-type="{"numeric" if c != "stockcode" else "string"}">{c}</th>' for c in df_main.columns) + '</tr></thead>')
-    html.append('<tbody>')
-    for _, r in df_main.iterrows():
-        stockcode = r['stockcode'].upper().strip()
-        row_class = 'highlight' if stockcode in highlights else ''
-        # Determine if stockcode is matched
-        is_matched = stockcode in matched_stockcodes
-        # Determine highlighting for stockcode cell
-        cell_classes = []
-        if stockcode in high_value_stocks:
-            cell_classes.append('high_value')
-        if stockcode in not_in_watchlist:
-            cell_classes.append('not_in_watchlist')
-        stockcode_class = ' '.join(cell_classes)
-        html.append(f'<tr class="{row_class}">')
-        for idx, c in enumerate(df_main.columns):
-            if c == 'stockcode':
-                cell_class_for_column = stockcode_class
-            elif idx == 1 and is_matched:  # Second column (margin_total)
-                cell_class_for_column = 'recent_match'
-            else:
-                cell_class_for_column = 'highlight_cell_main' if c in ['margin_%', 'total_premium_%'] and not np.isnan(
-                    r['margin_%']) and not np.isnan(r['total_premium_%']) and abs(r['margin_%']) < 0.6 * r[
-                                                                     'total_premium_%'] else ''
-                if c == 'net_%' and not np.isnan(r[c]) and r[c] >= 2:
-                    cell_class_for_column = 'net_highlight'
-                if c == 'initial_net_premium' and not np.isnan(r[c]) and r[c] < 0:
-                    cell_class_for_column = 'collar_credit'
-            value = f'{r[c]:.2f}' if isinstance(r[c], float) else r[c]
-            html.append(f'<td class="{cell_class_for_column}">{value}</td>')
-        html.append('</tr>')
-    html.append('</tbody>')
-    html.append('<tfoot><tr class="total">' + ''.join(
-        f'<td>{footer[c]:.2f}</td>' if isinstance(footer[c], float) else f'<td>{footer[c]}</td>' for c in
-        df_main.columns) + '</tr></tfoot>')
-    html.append('</table></div>')
+    html.append(render_table('main_positions', 'Main Positions', df_main, main_cols,
+                             highlight_masks(df_main, TABLE_RULES['main'], highlight_context), footer=tables['footer'], json_rows=json_rows))
 
     # Stocks in Positions but not in Watchlist
-    html.append(
-        '<div class="table-section"><h2>Stocks in Positions but not in Watchlist</h2><table id="positions_not_watchlist">')
-    html.append('<thead><tr>' + ''.join(f'<th data-type="{"numeric" if c != "stockcode" else "string"}">{c}</th>' for c in df_main.columns) + '</tr></thead>')
-    html.append('<tbody>')
-    for _, r in not_in_watchlist_df.iterrows():
-        stockcode = r['stockcode'].upper().strip()
-        is_matched = stockcode in matched_stockcodes
-        html.append(f'<tr>')
-        for idx, c in enumerate(df_main.columns):
-            if c == 'stockcode':
-                cell_classes = []
-                if stockcode in high_value_stocks:
-                    cell_classes.append('high_value')
-                if stockcode in not_in_watchlist:
-                    cell_classes.append('not_in_watchlist')
-                cell_class = ' '.join(cell_classes)
-            elif idx == 1 and is_matched:  # Second column (margin_total)
-                cell_class = 'recent_match'
-            else:
-                cell_class = ''
-                if c == 'initial_net_premium' and not np.isnan(r[c]) and r[c] < 0:
-                    cell_class = 'collar_credit'
-            value = f'{r[c]:.2f}' if isinstance(r[c], float) else r[c]
-            html.append(f'<td class="{cell_class}">{value}</td>')
-        html.append('</tr>')
-    html.append('</tbody>')
-    html.append('</table></div>')
+    html.append(render_table('positions_not_watchlist', 'Stocks in Positions but not in Watchlist',
+                             not_in_watchlist_df, main_cols,
+                             highlight_masks(not_in_watchlist_df, TABLE_RULES['not_in_watchlist'], highlight_context),
+                             json_rows=json_rows))
 
     # CE Filter Table
-    html.append('<div class="table-section"><h2>Filtered CE Options</h2><table id="filtered_ce">')
-    html.append('<thead><tr>' + ''.join(f'<th data-type="{"numeric" if c != "stockcode" else "string"}">{c}</th>' for c in df_ce.columns) + '</tr></thead>')
-    html.append('<tbody>')
-    for _, r in df_ce.iterrows():
-        stockcode = r['stockcode'].upper().strip()
-        is_matched = stockcode in matched_stockcodes
-        html.append(f'<tr>')
-        for idx, c in enumerate(df_ce.columns):
-            if c == 'stockcode':
-                cell_classes = []
-                if stockcode in high_value_stocks:
-                    cell_classes.append('high_value')
-                cell_class = ' '.join(cell_classes)
-            elif idx == 1 and is_matched:  # Second column (Avg_ce)
-                cell_class = 'recent_match'
-            else:
-                cell_class = ''
-            value = f'{r[c]:.2f}' if isinstance(r[c], float) else r[c]
-            html.append(f'<td class="{cell_class}">{value}</td>')
-        html.append('</tr>')
-    html.append('</tbody>')
-    html.append('</table></div>')
+    html.append(render_table('filtered_ce', 'Filtered CE Options', df_ce,
+                             {c: 'string' if c == 'stockcode' else 'numeric' for c in df_ce.columns},
+                             highlight_masks(df_ce, TABLE_RULES['ce'], highlight_context), json_rows=json_rows))
 
     # Movement Table with Cell Highlighting
-    html.append('<div class="table-section"><h2>Movement Metrics</h2><table id="movement_metrics">')
-    html.append('<thead><tr>' + ''.join(f'<th data-type="{"numeric" if c != "stockcode" else "string"}">{c}</th>' for c in df_move.columns) + '</tr></thead>')
-    html.append('<tbody>')
-    for _, r in df_move.iterrows():
-        stockcode = r['stockcode'].upper().strip()
-        is_matched = stockcode in matched_stockcodes
-        html.append(f'<tr>')
-        for idx, c in enumerate(df_move.columns):
-            if c == 'stockcode':
-                cell_classes = []
-                if stockcode in high_value_stocks:
-                    cell_classes.append('high_value')
-                cell_class = ' '.join(cell_classes)
-            elif idx == 1 and is_matched:  # Second column (pe_point)
-                cell_class = 'recent_match'
-            else:
-                cell_class = ''
-                if c in ['current % ', 'premium %'] and not np.isnan(r['current % ']) and not np.isnan(
-                        r['premium %']) and r['current % '] > r['premium %'] + 0.25:
-                    cell_class = 'highlight_cell_move'
-                elif c == 'left ce (%)' and r['ce_point'] != 0 and not np.isnan(r[c]) and r[c] < 0.5:
-                    cell_class = 'highlight_cell_move'
-            value = f'{r[c]:.2f}' if isinstance(r[c], float) else r[c]
-            total_current_pct = df_move['current % '].sum()
-            total_premium_pct = df_move['premium %'].sum()
-            total_stock_chg = df_move['stock_chg_%'].sum()
-
-            num_records = len(df_move)
-            avg_stock_chg = total_stock_chg / num_records if num_records > 0 else 0
-            move_footer = {col: 'TOTAL' if col == 'stockcode' else (
-                f'{total_current_pct:.2f}' if col == 'current % ' else
-                f'{total_premium_pct:.2f}' if col == 'premium %' else
-                f'{avg_stock_chg:.2f}' if col == 'stock_chg_%' else ''
-            ) for col in df_move.columns}
-
-            html.append(f'<td class="{cell_class}">{value}</td>')
-        html.append('</tr>')
-    html.append('</tbody>')
-    html.append('<tfoot><tr class="total">' + ''.join(
-        f'<td>{move_footer[c]}</td>' for c in df_move.columns) + '</tr></tfoot>')
-    html.append('</table></div>')
+    html.append(render_table('movement_metrics', 'Movement Metrics', df_move,
+                             {c: 'string' if c == 'stockcode' else 'numeric' for c in df_move.columns},
+                             highlight_masks(df_move, TABLE_RULES['move'], highlight_context), footer=tables['move_footer'], json_rows=json_rows))
 
     # Watchlist Stocks Not in Positions
-    html.append(
-        '<div class="table-section"><h2>Current Market Data for Watchlist Stocks Not in Positions</h2><table id="watchlist_not_positions">')
-    html.append('<thead><tr>' + ''.join(f'<th data-type="{"numeric" if c != "stockcode" and c != "Stock Classification" else "string"}">{c}</th>' for c in not_in_main_df.columns) + '</tr></thead>')
-    html.append('<tbody>')
-    for _, r in not_in_main_df.iterrows():
-        stockcode = r['stockcode'].upper().strip()
-        is_matched = stockcode in matched_stockcodes
-        html.append(f'<tr>')
-        for idx, c in enumerate(not_in_main_df.columns):
-            if c == 'stockcode':
-                cell_classes = []
-                if stockcode in high_value_stocks:
-                    cell_classes.append('high_value')
-                cell_class = ' '.join(cell_classes)
-            elif idx == 1 and is_matched:  # Second column (current_price)
-                cell_class = 'recent_match'
-            else:
-                cell_class = ''
-            value = f'{r[c]:.2f}' if isinstance(r[c], float) else r[c]
-            html.append(f'<td class="{cell_class}">{value}</td>')
-        html.append('</tr>')
-    html.append('</tbody>')
-    html.append('</table></div>')
-
-    html.append('</body></html>')
+    html.append(render_table('watchlist_not_positions', 'Current Market Data for Watchlist Stocks Not in Positions',
+                             not_in_main_df,
+                             {c: 'string' if c in ('stockcode', 'Stock Classification') else 'numeric'
+                              for c in not_in_main_df.columns},
+                             highlight_masks(not_in_main_df, TABLE_RULES['watchlist_not_positions'], highlight_context), json_rows=json_rows))
+
+    # Price Scenarios, when requested
+    if 'scenarios' in tables:
+        df_scenarios = tables['scenarios']
+        html.append(render_table('price_scenarios', 'Price Scenarios (P&L at Expiry)', df_scenarios,
+                                 {c: 'string' if c == 'stockcode' else 'numeric' for c in df_scenarios.columns},
+                                 highlight_masks(df_scenarios, TABLE_RULES['scenarios'], highlight_context),
+                                 footer=tables['scenario_footer'], json_rows=json_rows))
+
+    return render_page(html, vendor_dir)
+
+
+def write_report(html, output_path):
     try:
-        with open(OUTPUT_HTML, 'w', encoding='utf-8') as f:
-            f.write(''.join(html))
-        print(f"✅ Generated {OUTPUT_HTML}")
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.write(html)
+        print(f"✅ Generated {output_path}")
     except Exception as e:
         print(f"Error writing HTML file: {e}")
 
+
+def build_report(positions_path, reference, cache=None, positions=None):
+    """Compute the tables and page for one positions export; returns (tables, html), or None
+    when the export is missing.
+
+    positions may be a future already loading positions_path (see main()).
+    """
+    try:
+        if positions is not None:
+            df = positions.result()
+        else:
+            df = load_positions(positions_path, reference['cache_dir'], reference['chunk_rows'])
+    except FileNotFoundError:
+        print(f"Error: {positions_path} not found.")
+        return None
+    except Exception as e:
+        print(f"Error loading {positions_path}: {e}")
+        raise
+    note(rows=len(df))
+    tables = build_tables(df, reference, cache)
+    with stage('render html'):
+        html = render_report(tables, reference['vendor_dir'], reference['json_rows'])
+    return tables, html
+
+
+def record_tables(tables, reference, account=''):
+    """Append the tables to the snapshot history and export them, when the reference asks for it."""
+    if reference['history_dir']:
+        with stage('snapshot'):
+            append_snapshot(reference['history_dir'], tables, reference['date'], account)
+    if reference['export_dir']:
+        with stage('export tables'):
+            export_tables(tables, os.path.join(reference['export_dir'], account), reference['date'])
+
+
+def run_report(positions_path, reference, output_path=None, cache=None, account='', positions=None, publish=None):
+    """Build the report for one positions export, write it and record its tables; returns the tables.
+
+    publish(tables, html, reference) replaces writing the page to output_path.
+    """
+    note(positions=positions_path, output=output_path)
+    report = build_report(positions_path, reference, cache, positions)
+    if report is None:
+        return None
+    tables, html = report
+    if publish is None:
+        with stage('write html'):
+            write_report(html, output_path)
+    else:
+        publish(tables, html, reference)
+    record_tables(tables, reference, account)
+    return tables
+
+
+def main(directory=DEFAULT_DIRECTORY, output_path=OUTPUT_HTML, date=None, run_log=None, **options):
+    """Process positions.csv, generate financial metrics, and output to HTML.
+
+    options are load_reference()'s keyword options (use_cache, history, chunk_rows...).
+
+    Inputs are found and read in a small thread pool: the positions export is parsed while
+    the watchlist and stock codes load and the fuzzy index is built. Stage timings are
+    printed and, with run_log, appended to that JSON lines file; overlapping stages each
+    report their own wall time. Under --profile or --trace-memory the inputs load one
+    after another instead (see load_pool()).
+    """
+    with record_run(run_log, mode='report'), load_pool() or contextlib.nullcontext() as pool:
+        with stage('discover inputs'):
+            inputs = discover_inputs(directory, date or datetime.date.today(), pool=pool)
+        if inputs['positions'] is None:
+            raise FileNotFoundError(f"No files matching 'positions*.csv' found in {directory}.")
+        # Without a pool run_report() reads the positions itself, after the reference files
+        positions = pool.submit(load_positions, inputs['positions'],
+                                reference_cache_dir(directory, options.get('use_cache', True)),
+                                options.get('chunk_rows')) if pool else None
+        with stage('load reference'):
+            reference = load_reference(inputs, directory, pool=pool, **options)
+        return run_report(inputs['positions'], reference, output_path, positions=positions)
+
+
+# ==== WATCH MODE ====
+REPORT_INPUT_PATTERN = r'(positions(\(\d+\))?|Collar_.*|ALL PARAMETERS_.*|stock_codes)\.csv$'
+IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x008, 0x080, 0x100
+
+
+def inotify_watcher(directory):
+    """Wait for files written into directory using Linux inotify.
+
+    Returns wait(timeout) -> set of file names touched (empty on timeout). Raises OSError
+    where inotify is unavailable.
+    """
+    import ctypes
+    import ctypes.util
+    import select
+    import struct
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        inotify_init1, inotify_add_watch = libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError) as e:
+        raise OSError(f"inotify unavailable: {e}")
+    fd = inotify_init1(os.O_NONBLOCK)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    if inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+        os.close(fd)
+        raise OSError(ctypes.get_errno(), f"cannot watch {directory}")
+
+    def wait(timeout=None):
+        ready, _, _ = select.select([fd], [], [], timeout)
+        if not ready:
+            return set()
+        data = os.read(fd, 64 * 1024)
+        names, offset = set(), 0
+        while offset < len(data):
+            _, _, _, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+            offset += 16 + length
+            if name:
+                names.add(os.fsdecode(name))
+        return names
+    return wait
+
+
+def polling_watcher(directory, interval=2.0):
+    """Same interface as inotify_watcher, comparing (mtime, size) of the folder's files every interval."""
+    def snapshot():
+        files = {}
+        with os.scandir(directory) as entries:
+            for e in entries:
+                try:
+                    if e.is_file():
+                        st = e.stat()
+                        files[e.name] = (st.st_mtime_ns, st.st_size)
+                except FileNotFoundError:
+                    # Renamed or deleted since scandir listed it, e.g. a browser's temporary download
+                    continue
+        return files
+
+    last = snapshot()
+
+    def wait(timeout=None):
+        nonlocal last
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = interval if deadline is None else max(0.0, min(interval, deadline - time.monotonic()))
+            time.sleep(remaining)
+            current = snapshot()
+            changed = {name for name, sig in current.items() if last.get(name) != sig}
+            last = current
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+    return wait
+
+
+def watch(directory=DEFAULT_DIRECTORY, output_path=OUTPUT_HTML, date=None, debounce=2.0, poll_interval=2.0,
+          run_log=None, publish=None, **options):
+    """Rebuild the report whenever a positions, Collar, ALL PARAMETERS or stock codes export lands.
+
+    The watchlist, stock codes and fuzzy index stay loaded between refreshes and are only
+    re-read when one of their files changes (or the report date rolls over). A refresh waits
+    until the folder has been quiet for `debounce` seconds so half-written downloads are skipped.
+    publish is passed on to run_report() and options to load_reference(). Exports are
+    located and reference files read in a thread pool, as in main().
+    """
+    try:
+        wait = inotify_watcher(directory)
+        print(f"Watching {directory} (inotify)")
+    except OSError as e:
+        wait = polling_watcher(directory, poll_interval)
+        print(f"Watching {directory} (polling every {poll_interval}s; {e})")
+
+    pool = load_pool()
+    def input_changes(timeout=None):
+        """Report inputs touched within timeout; a transient OSError counts as no change."""
+        try:
+            return {name for name in wait(timeout) if re.match(REPORT_INPUT_PATTERN, name)}
+        except OSError as e:
+            print(f"Error watching {directory}: {e}")
+            time.sleep(poll_interval if timeout is None else min(poll_interval, timeout))
+            return set()
+
+    reference, reference_date = None, None
+    row_cache = {}
+    changed = {'positions.csv'}
+    while True:
+        report_date = date or datetime.date.today()
+        try:
+            with record_run(run_log, mode='watch', changed=sorted(changed)):
+                with stage('discover inputs'):
+                    inputs = discover_inputs(directory, report_date, pool=pool)
+                if reference is None or reference_date != report_date or any(
+                        not name.startswith('positions') for name in changed):
+                    with stage('load reference'):
+                        reference = load_reference(inputs, directory, pool=pool, **options)
+                    reference_date = report_date
+                if inputs['positions'] is None:
+                    print(f"No files matching 'positions*.csv' found in {directory}; waiting.")
+                else:
+                    run_report(inputs['positions'], reference, output_path, row_cache, publish=publish)
+        except Exception as e:
+            print(f"Error refreshing report: {e}")
+
+        changed = set()
+        while not changed:
+            changed = input_changes()
+        while True:
+            more = input_changes(debounce)
+            if not more:
+                break
+            changed |= more
+        print(f"Detected changes: {', '.join(sorted(changed))}")
+
+
+# ==== SERVE MODE ====
+def http_entry(body, content_type):
+    """A response body with its ETag and gzip variant, computed once per refresh."""
+    import gzip
+
+    return {'body': body, 'gzip': gzip.compress(body, 6), 'type': content_type,
+            'etag': hashlib.sha256(body).hexdigest()[:20]}
+
+
+def server_state(tables, html, date=None):
+    """Path -> response entry for the page, the table index and each table's JSON document."""
+    entries = {'/': http_entry(html.encode('utf-8'), 'text/html; charset=utf-8')}
+    index = {}
+    for name in TABLE_RULES:
+        if name not in tables:
+            continue
+        document = json.dumps(table_document(tables, name), separators=(',', ':'), allow_nan=False)
+        entry = entries[f'/tables/{name}.json'] = http_entry(document.encode('utf-8'), 'application/json')
+        index[name] = {'url': f'/tables/{name}.json', 'etag': entry['etag'], 'rows': len(tables[name])}
+    document = {'date': date.isoformat() if date else None, 'page_etag': entries['/']['etag'], 'tables': index}
+    entries['/tables'] = http_entry(json.dumps(document, separators=(',', ':')).encode('utf-8'), 'application/json')
+    return entries
+
+
+def report_request_handler():
+    import http.server
+
+    class ReportRequestHandler(http.server.BaseHTTPRequestHandler):
+        """Serves server.state, which a refresh replaces as a whole and never modifies."""
+
+        def do_GET(self):
+            self.respond(head=False)
+
+        def do_HEAD(self):
+            self.respond(head=True)
+
+        def respond(self, head):
+            state = self.server.state
+            path = self.path.split('?', 1)[0]
+            if path in ('/index.html', '/report.html'):
+                path = '/'
+            if state is None:
+                self.send_error(503, "Report not built yet")
+                return
+            entry = state.get(path)
+            if entry is None:
+                self.send_error(404)
+                return
+            compressed = 'gzip' in self.headers.get('Accept-Encoding', '')
+            etag = f'"{entry["etag"]}-gz"' if compressed else f'"{entry["etag"]}"'
+            if etag in {tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')}:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            body = entry['gzip'] if compressed else entry['body']
+            self.send_response(200)
+            self.send_header('Content-Type', entry['type'])
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Vary', 'Accept-Encoding')
+            if compressed:
+                self.send_header('Content-Encoding', 'gzip')
+            self.end_headers()
+            if not head:
+                self.wfile.write(body)
+
+        def log_request(self, code='-', size='-'):
+            pass
+
+    return ReportRequestHandler
+
+
+def serve(directory=DEFAULT_DIRECTORY, host='127.0.0.1', port=8000, date=None, debounce=2.0, poll_interval=2.0,
+          run_log=None, **options):
+    """Serve the report over HTTP from memory, recomputing it whenever a new export lands.
+
+    / is the report page, /tables lists the tables and /tables/<name>.json holds each one as
+    in export_tables(). Responses carry content ETags, so clients revalidating an unchanged
+    table get a 304. A refresh builds the complete new set of responses before swapping it in.
+    Refreshes otherwise run as in watch(), snapshots and --export included.
+    """
+    import http.server
+    import threading
+
+    server = http.server.ThreadingHTTPServer((host, port), report_request_handler())
+    server.state = None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving the report on http://{host}:{server.server_port}/")
+
+    def swap_state(tables, html, reference):
+        with stage('swap state'):
+            server.state = server_state(tables, html, reference['date'])
+
+    try:
+        watch(directory, None, date, debounce, poll_interval, run_log=run_log, publish=swap_state, **options)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# ==== BATCH MODE ====
+_worker_reference = None
+_worker_run_log = None
+
+
+def _init_worker(reference, run_log=None):
+    global _worker_reference, _worker_run_log
+    _worker_reference, _worker_run_log = reference, run_log
+
+
+def _run_account(positions_path, output_path, account):
+    with record_run(_worker_run_log, mode='batch account', account=account):
+        return run_report(positions_path, _worker_reference, output_path, account=account)
+
+
+def consolidate_main(results):
+    """Cross-account MAIN REPORT: amounts summed per stock, percentages recomputed on the totals.
+
+    A stock's max loss/profit is only defined when it is defined in every account holding it.
+    """
+    import pandas as pd
+
+    frames = [tables['main'].assign(account=name) for name, tables in results.items() if tables]
+    if not frames:
+        return None
+    rows = pd.concat(frames, ignore_index=True)
+    grouped = rows.groupby('stockcode', sort=True)
+    sums = grouped[['margin_total', 'margin_p/l', 'total_premium', 'total_net', 'max_loss', 'max_profit', 'delta',
+                    'theta']].sum()
+    undefined = rows[['max_loss', 'max_profit']].isna().groupby(rows['stockcode']).any()
+    margin = sums['margin_total'].where(sums['margin_total'] != 0)
+    consolidated = pd.DataFrame({
+        'stockcode': sums.index,
+        'margin_total': sums['margin_total'].to_numpy(),
+        'margin_%': grouped['margin_%'].first().to_numpy(),
+        'margin_p/l': sums['margin_p/l'].to_numpy(),
+        'total_premium': sums['total_premium'].to_numpy(),
+        'total_premium_%': (sums['total_premium'] / margin * 100).to_numpy(),
+        'total_net': sums['total_net'].to_numpy(),
+        'net_%': (sums['total_net'] / margin * 100).to_numpy(),
+        'max_loss': sums['max_loss'].mask(undefined['max_loss']).to_numpy(),
+        'max_profit': sums['max_profit'].mask(undefined['max_profit']).to_numpy(),
+        'delta': sums['delta'].to_numpy(),
+        'theta': sums['theta'].to_numpy(),
+        'accounts': grouped['account'].nunique().to_numpy(),
+    })
+    df_main, footer = finish_main_report(consolidated)
+    footer['accounts'] = len(frames)
+    context = {key: sorted({code for tables in results.values() if tables for code in tables['context'][key]})
+               for key in ('highlights', 'high_value', 'not_in_watchlist', 'matched')}
+    return {'main': df_main, 'footer': footer, 'context': context}
+
+
+def batch(positions_files, directory=DEFAULT_DIRECTORY, output_path=OUTPUT_HTML, date=None, workers=None,
+          run_log=None, **options):
+    """Build one report per account positions export in a process pool, plus a consolidated report.
+
+    The watchlist, stock codes and fuzzy index are loaded once and handed to each worker
+    when it starts. Account reports go to <output>_<account>.html and the cross-account
+    MAIN REPORT to <output>_consolidated.html. options are load_reference()'s keyword options.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    with record_run(run_log, mode='batch', accounts=len(positions_files)):
+        with load_pool() or contextlib.nullcontext() as loaders:
+            with stage('discover inputs'):
+                inputs = discover_inputs(directory, date or datetime.date.today(), positions=False, pool=loaders)
+            with stage('load reference'):
+                reference = load_reference(inputs, directory, pool=loaders, **options)
+        with stage('fuzzy index'):
+            prepare_matcher(reference['matcher'])
+
+        stem, ext = os.path.splitext(output_path)
+        jobs = {}
+        for path in positions_files:
+            name = account = os.path.splitext(os.path.basename(path))[0]
+            n = 1
+            while name in jobs:
+                n += 1
+                name = f'{account}_{n}'
+            jobs[name] = (path, f'{stem}_{name}{ext or ".html"}')
+
+        results = {}
+        with stage('account reports'), ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                           initargs=(reference, run_log)) as pool:
+            futures = {name: pool.submit(_run_account, *job, name) for name, job in jobs.items()}
+            for name, future in futures.items():
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    print(f"Error processing account {name}: {e}")
+                    results[name] = None
+
+        with stage('consolidated report'):
+            consolidated = consolidate_main(results)
+            if consolidated is not None:
+                df_main = consolidated['main']
+                html = render_page([render_table(
+                    'consolidated_positions', f'Consolidated Positions ({len(jobs)} accounts)', df_main,
+                    {c: 'string' if c == 'stockcode' else 'numeric' for c in df_main.columns},
+                    highlight_masks(df_main, MAIN_RULES, consolidated['context']), footer=consolidated['footer'],
+                    json_rows=reference['json_rows'])], reference['vendor_dir'])
+                write_report(html, f'{stem}_consolidated{ext or ".html"}')
+    return results, consolidated
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build the positions / collar HTML report.")
+    parser.add_argument('--dir', dest='directory', default=DEFAULT_DIRECTORY,
+                        help="folder with the broker and screener CSV exports (default: %(default)s)")
+    parser.add_argument('--output', default=OUTPUT_HTML, help="HTML report path (default: %(default)s)")
+    parser.add_argument('--date', type=datetime.date.fromisoformat, default=None,
+                        help="report date as YYYY-MM-DD, selects the Collar/ALL PARAMETERS exports (default: today)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help=f"do not read or write the parsed-input and match caches in <dir>/{CACHE_DIRNAME}")
+    parser.add_argument('--stream', action='store_true',
+                        help="read the positions export (or a full trade log) in chunks, folding rows per instrument")
+    parser.add_argument('--chunk-rows', type=int, default=STREAM_CHUNK_ROWS,
+                        help="rows per chunk with --stream (default: %(default)s)")
+    parser.add_argument('--offline', metavar='VENDOR_DIR', default=None,
+                        help="inline jQuery, DataTables and Select2 from VENDOR_DIR for a self-contained report")
+    parser.add_argument('--json-rows', action='store_true',
+                        help="embed table rows as JSON and let DataTables render only the visible page")
+    parser.add_argument('--export', metavar='DIR', default=None,
+                        help="also write every table with its highlight flags to DIR as Arrow files and tables.json "
+                             "(per account in DIR/<account> with --batch)")
+    parser.add_argument('--scenarios', action='store_true',
+                        help="add a table of each stock's P&L at expiry across a grid of underlying price moves")
+    parser.add_argument('--scenario-range', type=float, nargs=2, metavar=('LOW', 'HIGH'), default=list(SCENARIO_RANGE),
+                        help="smallest and largest price move in percent for --scenarios (default: %(default)s)")
+    parser.add_argument('--scenario-step', type=float, default=SCENARIO_STEP,
+                        help="percent between price moves for --scenarios (default: %(default)s)")
+    parser.add_argument('--no-history', action='store_true',
+                        help=f"do not append this run's tables to the snapshot store in <dir>/{HISTORY_DIRNAME}")
+    parser.add_argument('--history', metavar='TABLE', choices=SNAPSHOT_TABLES,
+                        help="print stored snapshots of a table (%(choices)s) instead of building the report")
+    parser.add_argument('--days', type=int, default=None,
+                        help="with --history, only the last DAYS report dates up to --date (default: all)")
+    parser.add_argument('--stock', action='append', default=None,
+                        help="with --history, only this stockcode (repeatable)")
+    parser.add_argument('--columns', nargs='+', default=None, help="with --history, only these columns")
+    parser.add_argument('--where', default=None,
+                        help="with --history, a row filter such as \"`left ce (%%)` < 0.5\"")
+    parser.add_argument('--batch', nargs='+', metavar='POSITIONS_CSV',
+                        help="build a report per account positions export, plus a consolidated report")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="worker processes for --batch (default: one per CPU)")
+    parser.add_argument('--watch', action='store_true',
+                        help="keep running and rebuild the report whenever a new export lands in --dir")
+    parser.add_argument('--serve', action='store_true',
+                        help="serve the report and per-table JSON over HTTP, recomputing when new exports land")
+    parser.add_argument('--host', default='127.0.0.1', help="address for --serve (default: %(default)s)")
+    parser.add_argument('--port', type=int, default=8000, help="port for --serve (default: %(default)s)")
+    parser.add_argument('--debounce', type=float, default=2.0,
+                        help="seconds the folder must be quiet before a watch refresh (default: %(default)s)")
+    parser.add_argument('--poll-interval', type=float, default=2.0,
+                        help="polling interval when inotify is unavailable (default: %(default)s)")
+    parser.add_argument('--run-log', default=None,
+                        help=f"JSON lines file for per-stage timings of each run (default: <dir>/{RUN_LOG_NAME})")
+    parser.add_argument('--no-run-log', action='store_true', help="print stage timings without logging them")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="also record each stage's peak Python allocations with tracemalloc (slower)")
+    parser.add_argument('--profile', metavar='PATH', default=None,
+                        help="write a cProfile of the run to PATH and print the top functions")
+    args = parser.parse_args(argv)
+    if args.scenario_step <= 0 or args.scenario_range[0] > args.scenario_range[1]:
+        parser.error("--scenario-range needs LOW <= HIGH and --scenario-step must be positive")
+    return args
+
+
+def cli(argv=None):
+    args = parse_args(argv)
+    if args.trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+    if args.profile:
+        import cProfile
+        import pstats
+
+        global _profiling
+        profiler = cProfile.Profile()
+        _profiling = True
+        try:
+            return profiler.runcall(run_command, args)
+        finally:
+            _profiling = False
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+    return run_command(args)
+
+
+def run_command(args):
+    run_log = None if args.no_run_log else args.run_log or os.path.join(args.directory, RUN_LOG_NAME)
+    options = {
+        'use_cache': not args.no_cache,
+        'history': not args.no_history,
+        'chunk_rows': args.chunk_rows if args.stream else None,
+        'vendor_dir': args.offline,
+        'json_rows': args.json_rows,
+        'export_dir': args.export,
+        'scenario_moves': scenario_moves(*args.scenario_range, args.scenario_step) if args.scenarios else None,
+    }
+    if args.history:
+        end = args.date or datetime.date.today()
+        start = end - datetime.timedelta(days=args.days - 1) if args.days else None
+        rows = read_history(os.path.join(args.directory, HISTORY_DIRNAME), args.history, start, end,
+                            args.stock, args.columns, args.where)
+        print(rows.to_string(index=False))
+        return 0
+    if args.batch:
+        batch(args.batch, args.directory, args.output, args.date, args.workers, run_log=run_log, **options)
+        return 0
+    if args.serve:
+        try:
+            serve(args.directory, args.host, args.port, args.date, args.debounce, args.poll_interval,
+                  run_log=run_log, **options)
+        except KeyboardInterrupt:
+            pass
+        return 0
+    if args.watch:
+        try:
+            watch(args.directory, args.output, args.date, args.debounce, args.poll_interval,
+                  run_log=run_log, **options)
+        except KeyboardInterrupt:
+            pass
+        return 0
+    try:
+        main(args.directory, args.output, args.date, run_log=run_log, **options)
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
+        return 1
+    return 0
+
+
 if __name__ == '__main__':
-    main()
+    sys.exit(cli())
 
 
 '''